@@ -0,0 +1,372 @@
+'''
+acquisition.py
+Photon counting with the DAQ card, in one place for every setup:
+expt.py, expt_supp.py and rabi_supp.py wrap these functions, with the
+channels of their setup taken from a named profile.
+
+A profile holds the channels of one setup:
+
+- pulsechan, countchan: timed counting (configure_counter), the
+  counter making the counting window and the photon counter;
+- photonchan, gatechan, trig, clockchan: gated counting
+  (make_gated_counters), with the detection gated by `trig` (e.g. a
+  spincore channel) and its windows timed by `clockchan`;
+- marker: terminal of the spincore marker channel, for counting
+  binned by marker pulses (clock_counter).
+
+Profiles can be changed, or new ones added, from a JSON file:
+
+>>>import acquisition
+>>>acquisition.load_profiles('profiles.json')
+>>>acquisition.get_profile('fusion')
+
+where profiles.json looks like
+
+    {"fusion": {"trig": "PFI39"},
+     "new_setup": {"photonchan": "Dev3/ctr0", "gatechan": "Dev3/ctr1",
+                   "trig": "/Dev3/PFI5", "clockchan": "Dev3/ctr2"}}
+
+The functions here leave their tasks uncommitted, so that a counter
+is reserved only while it runs, and other tasks (e.g. doct next to a
+monitor) can use the same channels in between. Long-lived objects
+that count many short windows, like rabi_supp.GatedCounter, commit
+their tasks themselves (see commit) and release them when closed.
+'''
+import json
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import PyDAQmx as daq
+from PyDAQmx import uInt32, int32, byref
+
+# --------
+# PROFILES
+# --------
+
+Profile = namedtuple('Profile', 'pulsechan countchan photonchan gatechan '
+                                'trig clockchan marker')
+
+PROFILES = dict(
+    # andrew's setup (expt.py)
+    andrew=Profile(pulsechan="Dev1/ctr1", countchan="Dev1/ctr0",
+                   photonchan="Dev2/ctr2", gatechan="Dev2/ctr3",
+                   trig="/Dev2/PFI5", clockchan="Dev2/ctr0",
+                   marker=None),
+    # Fusion setup (rabi_supp.py)
+    fusion=Profile(pulsechan="Dev1/ctr1", countchan="Dev1/ctr0",
+                   photonchan="Dev1/ctr0", gatechan="Dev1/ctr3",
+                   trig="PFI38", clockchan="Dev1/ctr1",
+                   marker=None),
+    # spincore-gated counting of expt_supp.py: the photon counter is
+    # paused by its default gate terminal. There is no gate terminal or
+    # window clock for make_gated_counters (trig, clockchan = None)
+    spincore=Profile(pulsechan="Dev1/ctr1", countchan="Dev1/ctr0",
+                     photonchan="Dev1/ctr0", gatechan="Dev1/ctr3",
+                     trig=None, clockchan=None,
+                     marker="/Dev1/PFI0"),
+)
+
+def get_profile(name):
+    """ the Profile called `name` """
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError('unknown setup profile %r (known: %s)'
+                         % (name, ', '.join(sorted(PROFILES))))
+
+def load_profiles(path):
+    """
+    Add or update profiles from the JSON file at `path`: an object of
+    profile name: {field: channel}. Fields left out keep their current
+    value (None for a new profile). Returns the names loaded.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for name, fields in config.items():
+        unknown = set(fields) - set(Profile._fields)
+        if unknown:
+            raise ValueError('profile %r: unknown fields %s'
+                             % (name, ', '.join(sorted(unknown))))
+        base = PROFILES.get(name, Profile(*[None] * len(Profile._fields)))
+        PROFILES[name] = base._replace(**fields)
+    return sorted(config)
+
+def timed_channels(profile):
+    """ keyword arguments of configure_counter for `profile` """
+    p = get_profile(profile)
+    return dict(pulsechan=p.pulsechan, countchan=p.countchan)
+
+def gated_channels(profile):
+    """ keyword arguments of make_gated_counters for `profile` """
+    p = get_profile(profile)
+    return dict(countchan=p.photonchan, gatechan=p.gatechan,
+                trig=p.trig, clockchan=p.clockchan)
+
+# -------------
+# TASK BUILDING
+# -------------
+
+def _internal_output(chan):
+    """ terminal of the internal output of counter `chan` """
+    return "/%sInternalOutput" % chan.replace('ctr', 'Ctr')
+
+def commit(*tasks):
+    """
+    Reserve and program the hardware for `tasks` now, so that each
+    later StartTask/StopTask is cheap. The channels stay reserved until
+    the tasks are cleared.
+    """
+    for task in tasks:
+        task.TaskControl(daq.DAQmx_Val_Task_Commit)
+
+def make_counter(countchan, trig=None, gated=None):
+    """
+    Configure the given counter to count, maybe with a pause trigger:
+    paused while `trig` is low. With gated=True and no `trig`, it is
+    paused by the counter's default gate terminal.
+    """
+    if gated is None:
+        gated = trig is not None
+    ctr = daq.Task()
+    ctr.CreateCICountEdgesChan(countchan, "",
+                               daq.DAQmx_Val_Rising,
+                               0,  # initial count
+                               daq.DAQmx_Val_CountUp)
+
+    if gated:
+        # configure pause trigger
+        ctr.SetPauseTrigType(daq.DAQmx_Val_DigLvl)
+        if trig is not None:
+            ctr.SetDigLvlPauseTrigSrc(trig)
+        ctr.SetDigLvlPauseTrigWhen(daq.DAQmx_Val_Low)
+
+    return ctr
+
+def make_pulse(duration, pulsechan):
+    """
+    Configure the counter `pulsechan` to output
+    a pulse of the given `duration` (in seconds).
+    """
+    pulse = daq.Task()
+    pulse.CreateCOPulseChanTime(
+        pulsechan, "",            # physical channel, name to assign
+        daq.DAQmx_Val_Seconds,   # units:seconds
+        daq.DAQmx_Val_Low,       # idle state: low
+        0.00, .0001, duration,   # initial delay, low time, high time
+    )
+    return pulse
+
+def make_sample_clock(period, nsamples, clockchan):
+    """
+    Configure the counter `clockchan` to output a finite train of
+    `nsamples` pulses, one every `period` seconds, to clock buffered
+    counters with.
+    """
+    clk = daq.Task()
+    clk.CreateCOPulseChanFreq(
+        clockchan, "",            # physical channel, name to assign
+        daq.DAQmx_Val_Hz,         # units: Hz
+        daq.DAQmx_Val_Low,        # idle state: low
+        0.00, 1. / period, .5)    # initial delay, frequency, duty cycle
+    clk.CfgImplicitTiming(daq.DAQmx_Val_FiniteSamps, nsamples)
+    return clk
+
+# --------------
+# TIMED COUNTING
+# --------------
+
+def configure_counter(duration=.1,
+                      pulsechan="Dev1/ctr1",
+                      countchan="Dev1/ctr0"):
+    """
+    Configure the card to count edges on `countchan`, for the specified
+    `duration` of time (seconds). This is a hardware-timed thing,
+    using the paired counter `pulsechan` to gate the detection
+    """
+    # configure pulse (for hardware timing)
+    pulse = make_pulse(duration, pulsechan)
+
+    # if these are paired counters, we can use the internal output
+    # of the pulsing channel to trigger the counting channel
+    ctr = make_counter(countchan, trig=_internal_output(pulsechan))
+
+    return pulse, ctr
+
+def start_count(pulse, ctr):
+    """ start counting events. """
+    # start counter
+    ctr.StartTask()
+    # fire pulse
+    pulse.StartTask()
+
+def finish_count(pulse, ctr):
+    """ finish counting events and return the result. """
+    # initialize memory for readout
+    count = uInt32()
+    # wait for pulse to be done
+    pulse.WaitUntilTaskDone(10.)
+    # timeout, ref to output value, reserved
+    ctr.ReadCounterScalarU32(10., byref(count), None)
+    pulse.StopTask()
+    ctr.StopTask()
+    return count.value
+
+def do_count(pulse, ctr):
+    """
+    simple counting in a synchronous mode
+    """
+    start_count(pulse, ctr)
+    return finish_count(pulse, ctr)
+
+def configure_counters(duration=.1,
+                       pulsechan="Dev1/ctr1",
+                       countchans=("Dev1/ctr0", "Dev1/ctr2")):
+    """
+    Multi-detector version of configure_counter: count edges on each of
+    `countchans` (e.g. two APDs, or an APD and a reference photodiode)
+    for the same `duration`. All the counters are paused by the one
+    pulse from `pulsechan`, so their windows coincide exactly.
+    """
+    pulse = make_pulse(duration, pulsechan)
+    trigchan = _internal_output(pulsechan)
+    ctrs = [make_counter(countchan, trig=trigchan)
+            for countchan in countchans]
+    return pulse, ctrs
+
+def start_counts(pulse, ctrs):
+    """ start counting events on all of `ctrs`. """
+    # the counters stay paused until the pulse fires
+    for ctr in ctrs:
+        ctr.StartTask()
+    pulse.StartTask()
+
+def finish_counts(pulse, ctrs):
+    """ finish counting events and return the counts as an array. """
+    counts = np.zeros(len(ctrs), dtype=np.uint32)
+    count = uInt32()
+    pulse.WaitUntilTaskDone(10.)
+    for i, ctr in enumerate(ctrs):
+        ctr.ReadCounterScalarU32(10., byref(count), None)
+        counts[i] = count.value
+    pulse.StopTask()
+    for ctr in ctrs:
+        ctr.StopTask()
+    return counts
+
+def do_counts(pulse, ctrs):
+    """
+    count on several channels at once, in a synchronous mode
+    """
+    start_counts(pulse, ctrs)
+    return finish_counts(pulse, ctrs)
+
+@contextmanager
+def counting(pulse, ctr):
+    """ `ctr` may also be a list of counters, from configure_counters """
+    ctrs = ctr if isinstance(ctr, (list, tuple)) else [ctr]
+    try:
+        yield
+    except KeyboardInterrupt:
+        # stop the counters
+        for ctr in ctrs:
+            try:
+                ctr.StopTask()
+                print("stopped counter")
+            except daq.DAQError:
+                print("no need to stop counter")
+        try:
+            pulse.StopTask()
+            print("stopped timer")
+        except daq.DAQError:
+            print("no need to stop timer")
+        raise
+
+def get_counts(ctr):
+    """ this stops ``ctr`` and returns its result """
+    count = uInt32()
+    ctr.ReadCounterScalarU32(10., byref(count), None)
+    ctr.StopTask()
+    return count.value
+
+# --------------
+# GATED COUNTING
+# --------------
+
+def make_gated_counters(t, n, countchan, gatechan, trig, clockchan):
+    """
+    Configure a photon counter on `countchan` (paused while the gate
+    `trig` is low) and a gate counter on `gatechan`, to record `n`
+    consecutive windows of `t` seconds each.
+
+    Both counters are armed by the first edge of a pulse train from
+    `clockchan`, so they start together, and latch their counts on
+    every following edge, so the windows are timed by the hardware and
+    there is no dead time between them.
+
+    Both `trig` and `clockchan` are needed: without a gate terminal the
+    photon counter would count continuously.
+    """
+    missing = [name for name, chan in (('trig', trig),
+                                       ('clockchan', clockchan))
+               if chan is None]
+    if missing:
+        raise ValueError('gated counting needs %s (set them in the '
+                         'profile, or pass them)' % ' and '.join(missing))
+    clk = make_sample_clock(t, n + 1, clockchan)
+    clock_src = _internal_output(clockchan)
+
+    pc = make_counter(countchan, trig=trig)
+    gc = make_counter(gatechan)
+    for ctr in (pc, gc):
+        ctr.SetArmStartTrigType(daq.DAQmx_Val_DigEdge)
+        ctr.SetDigEdgeArmStartTrigSrc(clock_src)
+        ctr.SetDigEdgeArmStartTrigEdge(daq.DAQmx_Val_Rising)
+        ctr.CfgSampClkTiming(clock_src, 1. / t, daq.DAQmx_Val_Rising,
+                             daq.DAQmx_Val_FiniteSamps, n)
+    return clk, pc, gc
+
+def read_gated_block(clk, pc, gc, n, timeout=10.):
+    """
+    Run the counters from make_gated_counters once, and return the
+    photons and gate edges counted in each of the `n` windows as
+    arrays.
+    """
+    counts = []
+    pc.StartTask()
+    gc.StartTask()
+    clk.StartTask()
+    try:
+        for ctr in (pc, gc):
+            latched = np.zeros(n, dtype=np.uint32)
+            read = int32()
+            ctr.ReadCounterU32(n, timeout, latched, n, byref(read), None)
+            # counts start from zero when armed; uint32 survives rollover
+            counts.append(np.diff(latched, prepend=np.uint32(0)))
+    finally:
+        clk.StopTask()
+        gc.StopTask()
+        pc.StopTask()
+    photons, pulses = counts
+    return photons, pulses
+
+def clock_counter(ctr, clock_src, n):
+    """
+    Latch the count of `ctr` on each rising edge of `clock_src` (e.g.
+    a spincore marker channel), for `n` edges.
+    """
+    ctr.CfgSampClkTiming(clock_src, 1.0e6,  # max rate, only a buffer size hint
+                         daq.DAQmx_Val_Rising,
+                         daq.DAQmx_Val_FiniteSamps, n)
+    return ctr
+
+def get_count_block(ctr, n, timeout=10.0):
+    """
+    The counts between consecutive clock edges, from a counter set up
+    by clock_counter. This stops ``ctr``.
+    """
+    latched = np.zeros(n, dtype=np.uint32)
+    read = int32()
+    ctr.ReadCounterU32(n, timeout, latched, n, byref(read), None)
+    ctr.StopTask()
+    # counts start from zero; uint32 differences survive rollover
+    return np.diff(latched, prepend=np.uint32(0))
@@ -1,111 +1,33 @@
 from __future__ import print_function
 import sys
 import time
+import numpy as np
 import PyDAQmx as daq
 from PyDAQmx import uInt32, int32, int16, byref
-from contextlib import contextmanager
+from ring_buffer import RingBuffer
+import acquisition
+from acquisition import (make_counter, make_pulse, make_sample_clock,
+                         start_count, finish_count, do_count,
+                         configure_counters, start_counts, finish_counts,
+                         do_counts, counting, get_counts, read_gated_block)
 
 # --------------
 # COUNTING STUFF
 # --------------
 
-def make_counter(countchan, trig=None):
-    """
-    Configure the given counter to count, maybe with a pause trigger.
-    """
-    ctr = daq.Task()
-    ctr.CreateCICountEdgesChan(countchan, "",
-                               daq.DAQmx_Val_Rising,
-                               0,  # initial count
-                               daq.DAQmx_Val_CountUp)
-
-    if trig is not None:
-        # configure pause trigger
-        ctr.SetPauseTrigType(daq.DAQmx_Val_DigLvl)
-        ctr.SetDigLvlPauseTrigSrc(trig)
-        ctr.SetDigLvlPauseTrigWhen(daq.DAQmx_Val_Low)
-
-    return ctr
-
-def make_pulse(duration, pulsechan):
-    """
-    Configure the counter `pulsechan` to output
-    a pulse of the given `duration` (in seconds).
-    """
-    pulse = daq.Task()
-    pulse.CreateCOPulseChanTime(
-        pulsechan, "",            # physical channel, name to assign
-        daq.DAQmx_Val_Seconds,   # units:seconds
-        daq.DAQmx_Val_Low,       # idle state: low
-        0.00, .0001, duration,   # initial delay, low time, high time
-    )
-    return pulse
+# The counting itself is in acquisition.py, shared with expt_supp.py
+# and rabi_supp.py; the channels default to andrew's setup profile.
 
-def configure_counter(duration=.1,
-                      pulsechan="Dev1/ctr1",
-                      countchan="Dev1/ctr0"):
+def configure_counter(duration=.1, profile='andrew', **channels):
     """
     Configure the card to count edges on `countchan`, for the specified
-    `duration` of time (seconds). This is a hardware-timed thing,
-    using the paired counter `pulsechan` to gate the detection
-    """
-
-    # configure pulse (for hardware timing)
-    pulse = make_pulse(duration, pulsechan)
-
-    # if these are paired counters, we can use the internal output
-    # of the pulsing channel to trigger the counting channel
-    trigchan = "/%sInternalOutput" % pulsechan.replace('ctr', 'Ctr')
-
-    # configure counter
-    ctr = make_counter(countchan, trig=trigchan)
-
-    return pulse, ctr
-
-def start_count(pulse, ctr):
-    """ start counting events. """
-    # start counter
-    ctr.StartTask()
-    # fire pulse
-    pulse.StartTask()
-    return
-
-def finish_count(pulse, ctr):
-    """ finish counting events and return the result. """
-    # initialize memory for readout
-    count = uInt32()
-    # wait for pulse to be done
-    pulse.WaitUntilTaskDone(10.)
-    # timeout, ref to output value, reserved
-    ctr.ReadCounterScalarU32(10., byref(count), None)
-    pulse.StopTask()
-    ctr.StopTask()
-    return count.value
-
-def do_count(pulse, ctr):
+    `duration` of time (seconds), using the paired counter `pulsechan`
+    to gate the detection. The channels not given are those of the
+    setup `profile` (see acquisition.py).
     """
-    simple counting in a synchronous mode
-    """
-    start_count(pulse, ctr)
-    return finish_count(pulse, ctr)
-
-@contextmanager
-def counting(pulse, ctr):
-    try:
-        yield
-    except KeyboardInterrupt:
-        # stop the counters
-        try:
-            ctr.StopTask()
-            print("stopped counter")
-        except daq.DAQError:
-            print("no need to stop counter")
-        try:
-            pulse.StopTask()
-            print("stopped timer")
-        except daq.DAQError:
-            print("no need to stop timer")
-        raise
+    kwargs = acquisition.timed_channels(profile)
+    kwargs.update(channels)
+    return acquisition.configure_counter(duration, **kwargs)
 
 def scan(gen, t=0.1, **kwargs):
     """threaded version"""
@@ -130,18 +52,148 @@ def gen_count_rate(t=0.1, **kwargs):
         y = do_count(p,c)/t
         yield time.time() - start, y
 
+class _DownsampledHistory(object):
+    """ one tier of CountRateMonitor: means over `width`-second bins """
+    def __init__(self, width, length):
+        self.width = float(width)
+        self.times = RingBuffer(length)
+        self.rates = RingBuffer(length)
+        self._bin = None
+        self._sum = 0.
+        self._n = 0
+
+    def add(self, t, rate):
+        b = int(t // self.width)
+        if b != self._bin:
+            if self._n:
+                self.times.append((self._bin + .5) * self.width)
+                self.rates.append(self._sum / self._n)
+            self._bin, self._sum, self._n = b, 0., 0
+        self._sum += rate
+        self._n += 1
+
+class CountRateMonitor(object):
+    """
+    Count rate monitor for long alignment sessions. Like gen_count_rate,
+    but the rates go into preallocated ring buffers, so memory stays
+    constant however long it runs:
+
+    - times/rates hold the last `size` raw points;
+    - history[name] holds means over coarser bins, one tier for each
+      (name, bin width in s, number of bins) in `tiers`;
+    - mean, std, min and max are kept as running statistics.
+
+    Displays should read view() / history_view(), which do not copy.
+
+    >>>mon = CountRateMonitor(t=.1)
+    >>>for t, rate in mon:
+    ...    line.set_data(*mon.view(500))
+    """
+    default_tiers = (('seconds', 1., 3600),
+                     ('minutes', 60., 24 * 60),
+                     ('hours', 3600., 24 * 30))
+
+    def __init__(self, t=0.1, size=10000, tiers=default_tiers, **kwargs):
+        self.t = t
+        self._kwargs = kwargs
+        self._counter = None
+        self.times = RingBuffer(size)
+        self.rates = RingBuffer(size)
+        self.history = dict((name, _DownsampledHistory(width, length))
+                            for name, width, length in tiers)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def std(self):
+        if self.n < 2:
+            return 0.
+        return np.sqrt(self._m2 / (self.n - 1))
+
+    def add(self, t, rate):
+        """ record a rate measured at time `t` (s) """
+        self.times.append(t)
+        self.rates.append(rate)
+        for tier in self.history.values():
+            tier.add(t, rate)
+        # Welford's running mean and variance
+        self.n += 1
+        delta = rate - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (rate - self.mean)
+        self.min = min(self.min, rate)
+        self.max = max(self.max, rate)
+
+    def view(self, n=None):
+        """ the last `n` raw (times, rates), as views """
+        return self.times.view(n), self.rates.view(n)
+
+    def history_view(self, name, n=None):
+        """ the last `n` (times, rates) of the tier `name`, as views """
+        tier = self.history[name]
+        return tier.times.view(n), tier.rates.view(n)
+
+    def __iter__(self):
+        """ count forever, yielding (t, rate) like gen_count_rate """
+        if self._counter is None:
+            self._counter = configure_counter(duration=self.t, **self._kwargs)
+        p, c = self._counter
+        start = time.time()
+        with counting(p, c):
+            while True:
+                y = do_count(p, c) / self.t
+                t = time.time() - start
+                self.add(t, y)
+                yield t, y
+
+def gen_count_rates(t=0.1, **kwargs):
+    """
+    multi-detector gen_count_rate: yields the time and an array of
+    rates, one per channel of `countchans`.
+    """
+    p,c = configure_counters(duration=t, **kwargs)
+    start = time.time()
+    while True:
+        y = do_counts(p,c)/t
+        yield time.time() - start, y
+
 # ---------------
 # PULSED COUNTING
 # ---------------
 
-def get_counts(ctr):
-    """ this stops ``ctr`` and returns its result """
-    count = daq.uInt32()
-    ctr.ReadCounterScalarU32(10., daq.byref(count), None)
-    ctr.StopTask()
-    return count.value
+def make_gated_counters(t, n, profile='andrew', **channels):
+    """
+    acquisition.make_gated_counters, with the channels (countchan,
+    gatechan, trig, clockchan) of the setup `profile` unless given.
+    """
+    kwargs = acquisition.gated_channels(profile)
+    kwargs.update(channels)
+    return acquisition.make_gated_counters(t, n, **kwargs)
 
-def gen_gated_counts(t=0.1):
+def gen_gated_blocks(t=0.1, n=10, **kwargs):
+    """
+    Block version of gen_gated_counts: yields the times and rates
+    of `n` back-to-back windows of `t` seconds at a time, as arrays.
+    Keyword arguments choose the channels (see make_gated_counters).
+    """
+    clk, pc, gc = make_gated_counters(t, n, **kwargs)
+    start = time.time()
+    while True:
+        t0 = time.time() - start
+        photons, pulses = read_gated_block(clk, pc, gc, n,
+                                           timeout=n * t + 10.)
+        rate = np.zeros(n)
+        gated = pulses > 0
+        rate[gated] = photons[gated] / pulses[gated].astype(float)
+        yield t0 + t * np.arange(1, n + 1), rate
+
+def gen_gated_counts(t=0.1, **kwargs):
     """
     equivalent of gen_count_rate when something else (e.g. a spincore
     sequence) is gating the detection, not a pulse we generate
@@ -149,39 +201,66 @@ def gen_gated_counts(t=0.1):
     This counts both photons and gate edges, and returns the rate as
     photons collected per gated detection period. Divide by the width
     of the window to get counts per second.
-    """
-    # photon counter
-    pc = make_counter("Dev2/ctr2", trig="/Dev2/PFI5")
-    # and the gate counter:
-    gc = make_counter("Dev2/ctr3")
-    # the paths here are for andrew's setup, hardcoded for now (sorry)
 
-    start = time.time()
-    while True:
-        gc.StartTask() # start both counters. this isn't
-        pc.StartTask() # exactly synchronous (error source)
-        time.sleep(t)
-        photons = get_counts(pc)
-        pulses  = get_counts(gc)
-        if pulses:
-            rate = photons / float(pulses)
-        else:
-            rate = 0.
-        yield time.time() - start, rate
+    The counting window is timed by the card, and the photon and gate
+    counters start together (see make_gated_counters).
+    """
+    # the default paths are for andrew's setup
+    for times, rates in gen_gated_blocks(t=t, n=1, **kwargs):
+        yield times[0], rates[0]
 
 # ---------------
 # SCANNING MIRROR
 # ---------------
 
+# DAC tasks are opened once per channel (or group of channels) and
+# shared by everything in the process, keyed by the tuple of channels.
+_dac_channels = {}
+
+def _dac_names(channel_name):
+    """ split a channel name or list of names into a tuple """
+    if isinstance(channel_name, str):
+        channel_name = channel_name.split(',')
+    return tuple(name.strip() for name in channel_name)
+
+def get_DAC_channel(channel_name="Dev2/ao0"):
+    """
+    Return the shared DACChannel for `channel_name`, opening it on
+    first use. `channel_name` may be a list of channels, e.g.
+    ("Dev2/ao0", "Dev2/ao1"), which are then written together.
+    """
+    names = _dac_names(channel_name)
+    if names not in _dac_channels:
+        # a channel can only belong to one task at a time
+        close_DAC_channels(names)
+        _dac_channels[names] = DACChannel(", ".join(names))
+    return _dac_channels[names]
+
+def close_DAC_channels(channel_name=None):
+    """
+    Clear the shared DAC tasks using any of the given channels
+    (all of them by default), e.g. before a timed AO task needs them.
+    """
+    names = None if channel_name is None else set(_dac_names(channel_name))
+    for key in list(_dac_channels):
+        if names is None or names.intersection(key):
+            _dac_channels.pop(key).close()
+
 def set_DAC_bits(num, channel_name="Dev2/ao0"):
     """
     Set the DAC bits to the given value (provide an integer between 0 and 2**12)
+
+    To set several channels at once, give a list of values and a list
+    of channels, e.g. set_DAC_bits((x, y), ("Dev2/ao0", "Dev2/ao1")).
     """
-    dc = DACChannel(channel_name)
+    dc = get_DAC_channel(channel_name)
     dc.set_value(num)
 
 class DACChannel(object):
-    """ encapsulates a DAC channel"""
+    """
+    encapsulates a DAC channel, or a comma-separated list of DAC
+    channels that are always written together.
+    """
     def __init__(self, name="Dev2/ao0"):
         self.ao = daq.Task()
         self.ao.CreateAOVoltageChan(
@@ -191,32 +270,50 @@ class DACChannel(object):
 
         # no timing (seems to be 1ms per sample)
         self.name = name
+        self.nchannels = len(_dac_names(name))
         self._value = None
 
     def get_value(self):
         return self._value
 
     def set_value(self, val):
+        if self.nchannels == 1:
+            val = int(val)
+        else:
+            val = tuple(int(v) for v in val)
+            assert len(val) == self.nchannels
+
+        # the output holds its last value, so don't write it again
+        if val == self._value:
+            return
+
         written = int32()
-        samples = int16(val)
+        # one sample per channel, in the order the channels were given
+        samples = np.array(val, dtype=np.int16, ndmin=1)
         self.ao.WriteRaw(
             1, True, 10.0,            # no of samples, autostart, timeout
-            byref(samples),           # data to actually write!
+            samples,                  # data to actually write!
             byref(written),           # output: the number of things written
             None)                     # reserved
 
         # verify that we wrote all the samples
         assert written.value == 1
 
-        self._value = int(val)
+        self._value = val
 
     value = property(get_value, set_value)
 
+    def close(self):
+        """ release the task """
+        self.ao.ClearTask()
+        self._value = None
+
 
 class GalvoPixel(object):
     """ encapsulates a Galvonometer at a given DAC channel"""
     def __init__(self, name="Dev2/ao0", bits=12, reverse=False):
-        self.dc = DACChannel(name)
+        self.name = name
+        self.dc = get_DAC_channel(name)
         self._value = None
         self.max_value = 2**bits
         self.factor = -1 if reverse else 1
@@ -226,7 +323,173 @@ class GalvoPixel(object):
 
     def set_value(self, val):
         realval = (self.factor * int(val)) % self.max_value
+        # look the channel up again, in case it was closed meanwhile
+        self.dc = get_DAC_channel(self.name)
         self.dc.set_value(realval)
         self._value = int(val) % self.max_value
 
-    value = property(get_value, set_value)
\ No newline at end of file
+    value = property(get_value, set_value)
+
+# --------------
+# RASTER IMAGING
+# --------------
+
+def raster_waveform(x_values, y_values, bits=12,
+                    reverse_x=False, reverse_y=False, snake=False):
+    """
+    Precompute the galvo waveform for a raster scan over the grid
+    `x_values` by `y_values` (DAC bits, as for GalvoPixel).
+
+    Returns an int16 array of shape (len(y_values), 2, len(x_values)+1):
+    for every line, the X and Y samples to write. The extra sample at
+    the end of each line holds the galvo still while the last pixel is
+    counted, and doubles as the flyback to the start of the next line.
+    With `snake`, every other line is scanned backwards.
+    """
+    xs = np.asarray(x_values, dtype=int)
+    ys = np.asarray(y_values, dtype=int)
+    max_value = 2**bits
+    xfactor = -1 if reverse_x else 1
+    yfactor = -1 if reverse_y else 1
+
+    wave = np.empty((len(ys), 2, len(xs) + 1), dtype=np.int16)
+    for j, y in enumerate(ys):
+        line = xs[::-1] if (snake and j % 2) else xs
+        wave[j, 0, :-1] = (xfactor * line) % max_value
+        wave[j, 0, -1] = wave[j, 0, -2]
+        wave[j, 1, :] = (yfactor * y) % max_value
+    return wave
+
+class GalvoRaster(object):
+    """
+    Hardware-timed raster imaging with a pair of galvos.
+
+    The X/Y waveform of each line (or of the whole frame) is written to
+    the AO channels up front and clocked out by the AO sample clock.
+    A buffered counter uses the same sample clock, so it latches the
+    photon count at every pixel boundary and the image falls out of
+    the differences, at whatever pixel rate the hardware allows.
+    """
+    def __init__(self, xchan="Dev2/ao0", ychan="Dev2/ao1",
+                 countchan="Dev2/ctr2", bits=12,
+                 reverse_x=False, reverse_y=False):
+        self.xchan = xchan
+        self.ychan = ychan
+        self.countchan = countchan
+        self.bits = bits
+        self.reverse_x = reverse_x
+        self.reverse_y = reverse_y
+        # the counter is clocked by the AO sample clock of the same card
+        self.clock = "/%s/ao/SampleClock" % xchan.split('/')[0]
+        self.ao = None
+        self.ctr = None
+        self._config = None
+
+    def _configure(self, nsamples, dwell):
+        """ (re)create the AO and counter tasks for `nsamples` points """
+        self.close()
+        # the static DAC tasks would hold on to the galvo channels
+        close_DAC_channels((self.xchan, self.ychan))
+        rate = 1. / dwell
+
+        self.ao = daq.Task()
+        self.ao.CreateAOVoltageChan(
+            "%s, %s" % (self.xchan, self.ychan), "",
+            0., 5., daq.DAQmx_Val_Volts,  # max, min, in units: Volts
+            None)                         # not using custom scale
+        self.ao.CfgSampClkTiming("", rate, daq.DAQmx_Val_Rising,
+                                 daq.DAQmx_Val_FiniteSamps, nsamples)
+
+        self.ctr = make_counter(self.countchan)
+        self.ctr.CfgSampClkTiming(self.clock, rate, daq.DAQmx_Val_Rising,
+                                  daq.DAQmx_Val_FiniteSamps, nsamples)
+        self._config = (nsamples, dwell)
+
+    def _run(self, wave, timeout):
+        """
+        clock out `wave` (shape (2, n)) and return the photon count
+        recorded at each of the n samples.
+        """
+        nsamples = wave.shape[1]
+        written = int32()
+        self.ao.WriteBinaryI16(
+            nsamples, False, timeout,     # samples per chan, autostart, timeout
+            daq.DAQmx_Val_GroupByChannel, # X samples first, then Y
+            np.ascontiguousarray(wave),
+            byref(written), None)
+        assert written.value == nsamples
+
+        latched = np.zeros(nsamples, dtype=np.uint32)
+        read = int32()
+        # arm the counter first, so it sees the very first clock edge
+        self.ctr.StartTask()
+        self.ao.StartTask()
+        try:
+            self.ctr.ReadCounterU32(nsamples, timeout, latched,
+                                    nsamples, byref(read), None)
+            self.ao.WaitUntilTaskDone(timeout)
+        finally:
+            self.ao.StopTask()
+            self.ctr.StopTask()
+
+        # counts accumulated while sitting at each sample; the last
+        # sample has no following edge, so it reads as zero.
+        counts = np.zeros(nsamples, dtype=np.uint32)
+        counts[:-1] = np.diff(latched)  # uint32 arithmetic survives rollover
+        return counts
+
+    def scan(self, x_values, y_values, dwell=.001, mode='line',
+             snake=False, timeout=10.):
+        """
+        Acquire an image over the grid `x_values` by `y_values`
+        (DAC bits), spending `dwell` seconds on each pixel.
+
+        mode='line' writes and runs one line at a time, which keeps the
+        AO buffer small; mode='frame' runs the whole image as a single
+        waveform. Returns the counts as an array of shape
+        (len(y_values), len(x_values)).
+        """
+        wave = raster_waveform(x_values, y_values, bits=self.bits,
+                               reverse_x=self.reverse_x,
+                               reverse_y=self.reverse_y, snake=snake)
+        nlines, _, nsamples = wave.shape
+
+        if mode == 'line':
+            if self._config != (nsamples, dwell):
+                self._configure(nsamples, dwell)
+            lines = [self._run(line, timeout) for line in wave]
+            counts = np.array(lines)
+        elif mode == 'frame':
+            frame = np.concatenate(list(wave), axis=1)
+            self._configure(frame.shape[1], dwell)
+            timeout = max(timeout, 2 * frame.shape[1] * dwell)
+            counts = self._run(frame, timeout).reshape(nlines, nsamples)
+        else:
+            raise ValueError("mode must be 'line' or 'frame'")
+
+        image = counts[:, :-1]
+        if snake:
+            image[1::2] = image[1::2, ::-1]
+        return image
+
+    def close(self):
+        """ release the AO and counter tasks """
+        for task in (self.ao, self.ctr):
+            if task is not None:
+                task.ClearTask()
+        self.ao = None
+        self.ctr = None
+        self._config = None
+
+def raster_scan(x_values, y_values, dwell=.001, mode='line', snake=False,
+                **kwargs):
+    """
+    Take one galvo image and release the hardware afterwards.
+    Keyword arguments are passed on to GalvoRaster.
+    """
+    raster = GalvoRaster(**kwargs)
+    try:
+        return raster.scan(x_values, y_values, dwell=dwell,
+                           mode=mode, snake=snake)
+    finally:
+        raster.close()
@@ -0,0 +1,184 @@
+'''
+expt_async.py
+asyncio versions of the counting tools in expt.py and of the
+instrument setters, so that writing one point to disk overlaps
+with setting and reading out the next, on one event loop.
+
+Example:
+
+>>>import asyncio
+>>>import expt_async
+>>>
+>>>agen = expt_async.AsyncInstrument(hp)
+>>>data = asyncio.run(expt_async.scan(freqs, set=agen.set_frequency,
+...                                   get=expt_async.doct, lag=0.1))
+'''
+import asyncio
+import functools
+import time
+import expt
+
+# -------
+# HELPERS
+# -------
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking call (a DAQ read, a GPIB write, ...) in the default
+    executor, so the event loop keeps going meanwhile.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+async def maybe_await(func, *args):
+    """ call `func`, awaiting it if it is a coroutine function """
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args)
+    return await run_blocking(func, *args)
+
+class AsyncInstrument(object):
+    """
+    Wraps an instrument (e.g. instruments.hp_8647) so that each of its
+    methods becomes a coroutine running in the executor. Calls to the
+    same instrument are serialized by a lock, since they share one
+    VISA resource.
+
+    >>>agen = AsyncInstrument(hp)
+    >>>await agen.set_frequency(2870.)
+    """
+    def __init__(self, inst):
+        self.inst = inst
+        self._lock = None
+        self._lock_loop = None
+
+    @property
+    def lock(self):
+        """
+        The lock, made in the running event loop the first time it is
+        needed (before Python 3.10 a lock belongs to the loop it was
+        made in, and the wrapper is usually made outside asyncio.run)
+        """
+        loop = asyncio.get_event_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.inst, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            async with self.lock:
+                return await run_blocking(method, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+# --------------
+# COUNTING STUFF
+# --------------
+
+async def start_count(pulse, ctr):
+    """ start counting events. """
+    await run_blocking(expt.start_count, pulse, ctr)
+
+async def finish_count(pulse, ctr, duration=0.):
+    """
+    finish counting events and return the result. Sleeping for the
+    `duration` of the window first leaves the loop free while the
+    card counts, instead of blocking in WaitUntilTaskDone.
+    """
+    if duration:
+        await asyncio.sleep(duration)
+    return await run_blocking(expt.finish_count, pulse, ctr)
+
+async def do_count(pulse, ctr, duration=0.):
+    """
+    simple counting, without blocking the event loop
+    """
+    await start_count(pulse, ctr)
+    return await finish_count(pulse, ctr, duration)
+
+# counters are configured once per window length and reused
+_counters = {}
+
+async def doct(t=.1):
+    """ async version of expt_supp.doct: count rate over `t` seconds """
+    if t not in _counters:
+        _counters[t] = expt.configure_counter(duration=t)
+    pulse, ctr = _counters[t]
+    with expt.counting(pulse, ctr):
+        return (await do_count(pulse, ctr, t)) / t
+
+# --------
+# SCANNING
+# --------
+
+async def scan(values, set, get, lag=0., sink=None):
+    """
+    Async scan loop: for each of `values` (any iterable), set it, wait
+    `lag` seconds and get a reading. `set`, `get` and `sink` may be
+    coroutine functions or plain (blocking) functions, which then run
+    in the executor.
+
+    Each point is set, settled and read before the next one is set,
+    so a reading never spans two setpoints. What overlaps is the sink:
+    `sink(value, reading)` (e.g. a disk write) runs while the
+    following point is set and read; at most one sink call is
+    outstanding, so points reach the sink in order.
+
+    Returns a list of (value, reading) pairs.
+    """
+    data = []
+    pending = None
+    start = time.time()
+    total = len(values) if hasattr(values, '__len__') else None
+    for i, value in enumerate(values):
+        await maybe_await(set, value)
+        await asyncio.sleep(lag)
+        reading = await maybe_await(get)
+        data.append((value, reading))
+
+        if sink is not None:
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(maybe_await(sink, value, reading))
+
+        if i == 0 and total:
+            end_time = start + (time.time() - start) * total
+            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+    if pending is not None:
+        await pending
+    return data
+    settling = asyncio.ensure_future(settle(value))
+    i = 0
+    while True:
+        await settling
+        next_value = next(values, _END)
+        reading = asyncio.ensure_future(maybe_await(get))
+        if overlap and next_value is not _END:
+            settling = asyncio.ensure_future(settle(next_value))
+        reading = await reading
+        data.append((value, reading))
+
+        if sink is not None:
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(maybe_await(sink, value, reading))
+
+        if i == 0 and total:
+            end_time = start + (time.time() - start) * total
+            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+        if next_value is _END:
+            break
+        if not overlap:
+            settling = asyncio.ensure_future(settle(next_value))
+        value = next_value
+        i += 1
+    if pending is not None:
+        await pending
+    return data
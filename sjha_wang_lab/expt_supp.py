@@ -5,10 +5,12 @@ These are primarily tools made to use the APD, as well
 as to use spincore to control the APD, AOM, lasers, etc.
 '''
 import expt
+import acquisition
+from acquisition import get_counts, clock_counter, get_count_block
 
 #DO a CounT
-def doct(t=.1):
-    pc = expt.configure_counter(duration=t)
+def doct(t=.1, profile='spincore'):
+    pc = expt.configure_counter(duration=t, profile=profile)
     with expt.counting(*pc):
         val = expt.do_count(*pc) / t
         return val
@@ -24,82 +26,135 @@ import time
 import PyDAQmx as daq
 #from PyDAQmx import * #don't like this, figure out where it's used. I think in make_counter(), make_gate_counter()
 import os
+import re
+import errno
 import itertools
+import numpy as np
 import sys
 from contextlib import contextmanager
+from session import get_session
+import pb_program as pb
+from pulse_seq import pulse, loop, call, sequence, compile_sequence, upload
+from pulse_seq import sweep_sequence, sweep_period
 
-if spin.pb_init() != 0:
-    print("Error initializing board: %s" % spin.pb_get_error())
-    input("Please press a key to continue.")
-    exit(-1)
-
-if spin.pb_count_boards()== 1: # check to see if we have one spincore card
-    spin.pb_core_clock(500) # sets the spincore clock to 500 MHz
-    #print("Ready to go!")
-else:
-    print("SpinCore board not found")
+#The board is not touched on import. It is initialized by the
+#process-wide session (see session.py) the first time something here
+#needs it, and stays up for every scan after that.
 
 #Check that there is a single spincore board, and set clock
 #to 500 MHz
 def spincore_status_check(print_ready=False):
-    if spin.pb_init() != 0:
-        print('Error initializing board: %s' % spin.pb_get_error())
-        input('Please press a key to continue.')
-        exit(-1)
-    
-    if spin.pb_count_boards() == 1: # check to see if we have one spincore card
-        spin.pb_core_clock(500) # sets the spincore clock to 500 MHz
-        if print_ready:
-            print('Ready to go!')
-    else:
-        print('SpinCore board not found')
+    get_session()
+    if print_ready:
+        print('Ready to go!')
 
 #Checks if pulse sequence has finished
 def is_stopped():   
     status = spin.pb_read_status()
     return status['stopped']    
 
-#Start pulse sequence, check every .1 s to see if it has
-#finished
-def pulse_blast():
+#Start pulse sequence and wait for it to finish. The run time is
+#worked out from the program on the board, so we sleep until just
+#before it ends, then poll with a short, growing interval. Returns
+#the dead time (s): how long after the expected end the stop was seen.
+def pulse_blast(margin=.002, poll=.0005, max_poll=.1,
+                on_poll=None, poll_every=10.0):
+    session = get_session()
+    program = session.loaded_program
+    duration = None
+    if program is not None:
+        duration = pb.program_duration(program) * 10.0**-9.0
+    
     spin.pb_start()
-    i=0
+    start_time = time.time()
+    
+    if duration is None or duration == float('inf'):
+        #unknown or endless program: just poll
+        end_time = start_time
+    else:
+        end_time = start_time + duration
+        #on_poll (e.g. reading counters before they wrap) runs
+        #every poll_every seconds of a long program
+        while True:
+            remaining = end_time - margin - time.time()
+            if on_poll is None or remaining <= poll_every:
+                break
+            time.sleep(poll_every)
+            on_poll()
+        time.sleep(max(0., end_time - margin - time.time()))
+    
     while not is_stopped():
-        #print('Please wait... %r' % i)
-        time.sleep(.1)
-        i += 1
-    #print('Finished')
+        time.sleep(poll)
+        poll = min(2 * poll, max_poll)
+    stop_time = time.time()
+    
     spin.pb_stop()
-
-#this is from old file naming convention.
-#Replace with new one.
+    return stop_time - end_time
+
+#Hands out numbered filenames (fmt % i) in `dir`. The directory is
+#listed once, the taken indices are parsed from the names, and each
+#name is claimed by creating it (empty) with O_EXCL, so two processes
+#never get the same one: on a collision the next index is tried.
+class FilenameAllocator(object):
+    def __init__(self, dir='.', fmt="data%03d.npy", start=1):
+        self.dir = dir
+        self.fmt = fmt
+        self.next_index = start
+        self.pattern = self._compile(fmt)
+        self.taken = set()
+        for name in os.listdir(dir):
+            match = self.pattern.match(name)
+            if match:
+                self.taken.add(int(match.group(1)))
+    
+    @staticmethod
+    def _compile(fmt):
+        #regex matching the names fmt % i, e.g. data(\d+)\.npy
+        match = re.search(r'%0?\d*d', fmt)
+        if match is None or '%' in fmt[:match.start()] + fmt[match.end():]:
+            raise ValueError('fmt must have exactly one %%d field: %r' % (fmt,))
+        return re.compile(re.escape(fmt[:match.start()]) + r'(\d+)'
+                          + re.escape(fmt[match.end():]) + '$')
+    
+    def next(self):
+        """ claim and return the lowest free name from next_index on """
+        for i in itertools.count(self.next_index):
+            if i in self.taken:
+                continue
+            name = self.fmt % i
+            try:
+                fd = os.open(os.path.join(self.dir, name),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self.taken.add(i) #claimed by someone else meanwhile
+                continue
+            os.close(fd)
+            self.taken.add(i)
+            self.next_index = i + 1
+            return name
+
+_filename_allocators = {}
+
+#The next free filename, fmt % i with i >= start. The file is created
+#(empty) to claim it; write the data over it. Uses a cached
+#FilenameAllocator per directory and format.
 def get_next_filename(dir='.', fmt="data%03d.npy", start=1):
-    for i in itertools.count(start):
-        if fmt % i not in os.listdir(dir):
-            return fmt % i
+    key = (os.path.abspath(dir), fmt, start)
+    if key not in _filename_allocators:
+        _filename_allocators[key] = FilenameAllocator(dir, fmt, start)
+    return _filename_allocators[key].next()
 
 #Makes a counter that counts when the gate is high and
 #pause when the gate is low
-def make_counter():
-    ctr = daq.Task()
-    ctr.CreateCICountEdgesChan("Dev1/ctr0", "",
-                              daq.DAQmx_Val_Rising,
-                              0, # initial count
-                              daq.DAQmx_Val_CountUp)
-    # configure pause trigger
-    ctr.SetPauseTrigType(daq.DAQmx_Val_DigLvl)
-    ctr.SetDigLvlPauseTrigWhen(daq.DAQmx_Val_Low)
-    
-    return ctr
+def make_counter(profile='spincore'):
+    p = acquisition.get_profile(profile)
+    return acquisition.make_counter(p.photonchan, trig=p.trig, gated=True)
 
 #Counts the number of times the gate was activated
-def make_gate_counter():
-    ctr = daq.Task()
-    ctr.CreateCICountEdgesChan("Dev1/ctr3", "",
-                              daq.DAQmx_Val_Rising,
-                              0, #initial count
-                              daq.DAQmx_Val_CountUp)
-    return ctr
+def make_gate_counter(profile='spincore'):
+    return acquisition.make_counter(acquisition.get_profile(profile).gatechan)
 
 #context manager for convenience
 @contextmanager
@@ -130,26 +185,53 @@ def finish_sequence(*tasks):
         task.WaitUntilTaskDone(10.)
         task.StopTask()
 
-#get photon counts [from APD]
-def get_counts(ctr): # must give it the channel to look into
-    count = daq.uInt32()
-    #ctr.WaitUntilTaskDone(10.) # not sure what for but could be useful?
-    ctr.ReadCounterScalarU32(10.0, daq.byref(count), None)
-    ctr.StopTask()
-    return count.value
-
-#Make a measurement.
-def make_measurement():
+#get_counts (get photon counts [from APD]) comes from acquisition.py
+
+#64-bit running total of a (32-bit) counter task, read while it
+#runs. update() must be called before the counter can wrap around,
+#i.e. before 2**32 counts; make_measurement does this from
+#pulse_blast, so long averages come back in one measurement.
+class CountAccumulator(object):
+    def __init__(self, ctr):
+        self.ctr = ctr
+        self.total = 0
+        self._last = 0
+    
+    def update(self, timeout=10.0):
+        count = daq.uInt32()
+        self.ctr.ReadCounterScalarU32(timeout, daq.byref(count), None)
+        self.total += (count.value - self._last) % 2**32
+        self._last = count.value
+        return self.total
+
+#clock_counter and get_count_block, for counts binned by marker
+#pulses, come from acquisition.py
+
+#Make a measurement. With return_dead_time, also returns the
+#dead time measured by pulse_blast.
+def make_measurement(return_dead_time=False):
     gc = make_gate_counter()
     pc = make_counter()
     
+    photon_total = CountAccumulator(pc)
+    pulse_total = CountAccumulator(gc)
+    
+    def read_totals():
+        photon_total.update()
+        pulse_total.update()
+    
     with acquiring(pc, gc):
         start_sequence(gc, pc)
-        pulse_blast()
-        photons = get_counts(pc)
-        pulses = get_counts(gc)
-        finish_sequence(gc,pc)
+        dead_time = pulse_blast(on_poll=read_totals)
+        photons = photon_total.update()
+        pulses = pulse_total.update()
+        #the counters are untimed, so they never finish by themselves:
+        #stop them, as get_counts does
+        pc.StopTask()
+        gc.StopTask()
     #print(photons, pulses)
+    if return_dead_time:
+        return photons, pulses, dead_time
     return photons, pulses
 
 ###########################################################
@@ -164,7 +246,8 @@ pulse_dict = dict(
                   all_on = 0b111000000000000000000000,
                   green = 0b111000000000000000000001,
                   mw = 0b111000000000000000001000,
-                  detection = 0b111000000000000000000011
+                  detection = 0b111000000000000000000011,
+                  marker = 0b111000000000000000010000
                  )
 
 #add a pulse to pulse_dict, or change an existing pulse.
@@ -202,6 +285,7 @@ def write_pulse(pulse_name, bits, num_channels=4):
 #spin.pb_stop(), all_off(), and green_off() are all
 #equivalent. Stop all pulses.
 def all_off():
+    get_session()
     spin.pb_stop()
 
 #start custom pulse. It will be on for at least 1 s.
@@ -211,12 +295,8 @@ def custom_on(custom_pulse, pulse_name='custom', num_channels=4):
     
     custom = pulse_dict[pulse_name]
     
-    spin.pb_start_programming(spin.PULSE_PROGRAM)
-
-    start = spin.pb_inst_pbonly(custom, spin.CONTINUE, 0, 500)
-    spin.pb_inst_pbonly(custom, spin.BRANCH, start, 500)
-
-    spin.pb_stop_programming()
+    upload(compile_sequence(sequence([pulse(500, custom),
+                                      pulse(500, custom)], end='branch')))
     
     spin.pb_start()
 
@@ -228,18 +308,15 @@ def green_on(green_pulse='default', num_channels=4):
     
     green = pulse_dict['green']
     
-    spin.pb_start_programming(spin.PULSE_PROGRAM)
-
-    start = spin.pb_inst_pbonly(green, spin.CONTINUE, 0, 500)
-    spin.pb_inst_pbonly(green, spin.BRANCH, start, 500)
-
-    spin.pb_stop_programming()
+    upload(compile_sequence(sequence([pulse(500, green),
+                                      pulse(500, green)], end='branch')))
     
     spin.pb_start()
 
 #spin.pb_stop(), all_off(), and green_off() are all
 #equivalent. Stop all pulses.
 def green_off():
+    get_session()
     spin.pb_stop()
 
 ###########################################################
@@ -265,26 +342,29 @@ def rabi_pulse(mw_duration, loop_num=500000,
     green = pulse_dict['green']
     det = pulse_dict['detection']
     
-    #note: rabi_program won't take loop_num > 2**20 = 1048576
+    #loop_num > 2**20 = 1048576 is compiled into nested loops
     
-    spin.pb_start_programming(spin.PULSE_PROGRAM)
-
-    start = spin.pb_inst_pbonly(green, spin.JSR, 2, green_time) # JSR wants instruction line of the subroutine. Turn on green, go into subroutine (starting with sub = line) below
-    spin.pb_inst_pbonly(off, spin.STOP, 0, off_time) #turn everything off. This occurs after the subroutine below.
-
-    sub = spin.pb_inst_pbonly(off, spin.LOOP, loop_num, delay_time) #Begin subroutine loop. Delay is so that, for different mw times, loop as a whole (i.e., duty cycle) has the same amount of time.
-    spin.pb_inst_pbonly(mw, spin.CONTINUE, 0, mw_time) #microwave pulse for state transfer.
-    spin.pb_inst_pbonly(green, spin.CONTINUE, 0, off_time) #accounts for delay between telling green to turn on and green actually turning on.
-    spin.pb_inst_pbonly(det, spin.CONTINUE, 0, det_time) #detection pulse
-    spin.pb_inst_pbonly(green, spin.END_LOOP, sub, green_time) #End subroutine loop. Initialization pulse, it's at the end of the loop, intended for next loop.
+    seq = sequence(
+        [call('rabi', green_time, green), # Turn on green, go into subroutine below
+         pulse(off_time, off)], #turn everything off. This occurs after the subroutine below.
+        subroutines=dict(rabi=[
+            loop(loop_num,
+                 pulse(delay_time, off), #Begin subroutine loop. Delay is so that, for different mw times, loop as a whole (i.e., duty cycle) has the same amount of time.
+                 pulse(mw_time, mw), #microwave pulse for state transfer.
+                 pulse(off_time, green), #accounts for delay between telling green to turn on and green actually turning on.
+                 pulse(det_time, det), #detection pulse
+                 pulse(green_time, green)), #End subroutine loop. Initialization pulse, it's at the end of the loop, intended for next loop.
+            pulse(green_time, green)])) #After loops. Extra instruction needed after loop, chose green on arbitrarily.
     
-    spin.pb_inst_pbonly(green, spin.RTS, 0, green_time) #After loops. Extra instruction needed after loop, chose green on arbitrarily.
-
-    spin.pb_stop_programming()
+    #compiled programs are cached, and the board is only
+    #reprogrammed when the program changes.
+    upload(compile_sequence(seq))
 
 #Measurements for Rabi oscillation pulse sequence
+#With report_dead_time, prints the time lost after each sequence.
 def gen_scan(widths, loop_num=500000, repeat_each_pulse_width=1,
-             green_time=2300, det_time=300, off_time=650):
+             green_time=2300, det_time=300, off_time=650,
+             report_dead_time=False):
     
     repeat_each_pulse_width = int(repeat_each_pulse_width)
     cnt_arr = []
@@ -295,7 +375,9 @@ def gen_scan(widths, loop_num=500000, repeat_each_pulse_width=1,
     for w in widths:
         
         rabi_pulse(w, loop_num=loop_num, green_time=green_time, det_time=det_time, off_time=off_time)
-        photons, pulses = make_measurement()
+        photons, pulses, dead_time = make_measurement(return_dead_time=True)
+        if report_dead_time:
+            print('Width %s ns: dead time %.1f ms' % (w, dead_time * 1000.0))
         #count_time = det_time * spin.ns * pulses
         count_time = det_time * (spin.ns * 10.0**-9.0) * pulses
         counts = photons / count_time
@@ -319,3 +401,134 @@ def gen_scan(widths, loop_num=500000, repeat_each_pulse_width=1,
             yield (w - 1), cnt_arr[cnt_arr_ind]
     
     spin.pb_stop()
+
+#Rabi sequence with all the widths in one program: a loop block per
+#width, each followed by a marker pulse. The marker clocks buffered
+#counters (see gen_scan_batched), so each width gets its own bin.
+def rabi_batch_pulse(widths, loop_num=500000,
+                     green_time=2300, det_time=300, off_time=650,
+                     marker_time=100):
+    
+    #a 5500 ns pad + mw pulse keeps the duty cycle the same for every width
+    period = 5500 + off_time + det_time + green_time
+    upload(compile_sequence(sweep_sequence('rabi', widths, loop_num=loop_num,
+                                           period=period,
+                                           green_time=green_time,
+                                           det_time=det_time,
+                                           off_time=off_time,
+                                           marker_time=marker_time)))
+
+#Run the program on the board `repeat` times, counting photons and
+#gate pulses in `n` bins, one per marker pulse. Returns the rates
+#(counts per second of detection window) of each bin.
+def count_marker_bins(n, det_time, repeat=1, marker_src=None,
+                      profile='spincore'):
+    
+    if marker_src is None:
+        marker_src = acquisition.get_profile(profile).marker
+    
+    photons = np.zeros(n)
+    pulses = np.zeros(n)
+    for i in range(repeat):
+        gc = clock_counter(make_gate_counter(profile), marker_src, n)
+        pc = clock_counter(make_counter(profile), marker_src, n)
+        with acquiring(pc, gc):
+            start_sequence(gc, pc)
+            pulse_blast()
+            photons += get_count_block(pc, n)
+            pulses += get_count_block(gc, n)
+        pc.ClearTask()
+        gc.ClearTask()
+    
+    count_time = det_time * (spin.ns * 10.0**-9.0) * pulses
+    counts = np.zeros(n)
+    gated = pulses > 0
+    counts[gated] = photons[gated] / count_time[gated]
+    return counts
+
+#Batched version of gen_scan: each program holds `batch` widths, and
+#a photon and a gate counter, clocked by the marker channel, bin the
+#counts per width. The whole Rabi curve is one hardware run (per
+#batch), instead of one program, run and measurement per width.
+#Make sure the marker channel is wired to `marker_src` (by default,
+#the marker terminal of the setup profile, see acquisition.py).
+def gen_scan_batched(widths, loop_num=500000, repeat_each_pulse_width=1,
+                     green_time=2300, det_time=300, off_time=650,
+                     marker_src=None, marker_time=100, batch=500,
+                     profile='spincore'):
+    
+    repeat_each_pulse_width = int(repeat_each_pulse_width)
+    widths = np.asarray(widths, dtype=float)
+    start_time = time.time()
+    
+    for first in range(0, len(widths), batch):
+        chunk = widths[first:first + batch]
+        n = len(chunk)
+        rabi_batch_pulse(chunk, loop_num=loop_num, green_time=green_time,
+                         det_time=det_time, off_time=off_time,
+                         marker_time=marker_time)
+        counts = count_marker_bins(n, det_time, repeat=repeat_each_pulse_width,
+                                   marker_src=marker_src, profile=profile)
+        
+        if first == 0:
+            end_time = start_time + ((time.time() - start_time) * len(widths) / float(n))
+            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+        
+        #same x as gen_scan
+        for w, c in zip(chunk, counts):
+            yield (w - 1), c
+    
+    spin.pb_stop()
+
+#Sweep of a measurement family (rabi, ramsey, t1 or echo, see
+#pulse_seq.sweep_sequence) over `values` (ns), with the batched,
+#marker-binned counting of gen_scan_batched. Results stream out after
+#every batch of `batch` values, so keep it small enough to watch.
+#
+#With references (needs pi_time), every value has its own bright
+#(no microwaves) and dark (pi pulse) reference, and the value yielded
+#is the normalized signal (signal - dark) / (bright - dark): 1 for
+#m=0, 0 for m=1. With raw, yields (value, signal, bright, dark) rates
+#instead.
+def gen_sweep_batched(family, values, pi_time=None, loop_num=500000,
+                      references=True, repeat=1, period=None,
+                      green_time=2300, det_time=300, off_time=650,
+                      marker_src=None, marker_time=100, batch=20,
+                      raw=False, profile='spincore'):
+    
+    values = np.asarray(values, dtype=float)
+    bins = 3 if references else 1
+    start_time = time.time()
+    
+    if period is None:
+        #one period for the whole sweep, so every batch has the same duty cycle
+        period = sweep_period(family, values, pi_time=pi_time,
+                              references=references, green_time=green_time,
+                              det_time=det_time, off_time=off_time)
+    
+    for first in range(0, len(values), batch):
+        chunk = values[first:first + batch]
+        n = len(chunk) * bins
+        upload(compile_sequence(sweep_sequence(
+            family, chunk, loop_num=loop_num, pi_time=pi_time,
+            references=references, period=period, green_time=green_time,
+            det_time=det_time, off_time=off_time, marker_time=marker_time)))
+        counts = count_marker_bins(n, det_time, repeat=repeat,
+                                   marker_src=marker_src,
+                                   profile=profile).reshape(len(chunk), bins)
+        
+        if first == 0:
+            end_time = start_time + ((time.time() - start_time) * len(values) / float(len(chunk)))
+            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+        
+        for x, c in zip(chunk, counts):
+            if raw:
+                yield (x,) + tuple(c)
+            elif references:
+                signal, bright, dark = c
+                contrast = bright - dark
+                yield x, (signal - dark) / contrast if contrast else 0.
+            else:
+                yield x, c[0]
+    
+    spin.pb_stop()
@@ -27,6 +27,7 @@ hp_e4401(inst)
 
 import numpy as np
 import sys
+import time
 
 ###########################################################
 #Generally useful functions
@@ -1144,6 +1145,68 @@ class hp_e4401(object):
     def set_reference_level(self, dBm):
         self.inst.write('DISP:WIND:TRAC:Y:SCAL:RLEV ' + str(dBm))
     
+    #get sweep time [s].
+    def get_sweep_time(self):
+        return float(self.inst.query('SENS:SWE:TIME?'))
+    
+    #continuous sweeping (1), or one sweep per INIT (0).
+    def set_continuous(self, on):
+        if on in ['on', True, 1]:
+            self.inst.write('INIT:CONT ON')
+        elif on in ['off', False, 0]:
+            self.inst.write('INIT:CONT OFF')
+        else:
+            raise ValueError('set_continuous takes 0 for off, 1 for on')
+    
+    #default time to wait for one sweep [s]: twice the sweep
+    #time, plus a second for the bus and the display. Queries the
+    #sweep time, so get it once per scan, not once per sweep.
+    def get_sweep_timeout(self):
+        return 2.0 * self.get_sweep_time() + 1.0
+    
+    #take one fresh sweep, and return when it is complete.
+    #*OPC? only answers once the sweep is done, so this blocks
+    #(the bus) for exactly as long as the sweep takes. Use with
+    #set_continuous(0). Raises RuntimeError after timeout [s].
+    def sweep(self, timeout=None):
+        if timeout is None:
+            timeout = self.get_sweep_timeout()
+        old_timeout = self.inst.timeout
+        self.inst.timeout = 1000.0 * timeout #VISA timeouts are in ms
+        try:
+            self.inst.query('INIT:IMM;*OPC?')
+        except Exception as e:
+            raise RuntimeError('sweep did not complete within %g s (%s)' % (timeout, e))
+        finally:
+            self.inst.timeout = old_timeout
+    
+    #start one sweep, without waiting for it (see wait_sweep).
+    def start_sweep(self):
+        self.inst.write('*CLS;INIT:IMM;*OPC')
+    
+    #wait for the sweep from start_sweep to complete, polling the
+    #operation complete bit of the event status register every
+    #poll [s]. The bus stays free in between. Raises RuntimeError
+    #after timeout [s].
+    def wait_sweep(self, timeout=None, poll=0.01):
+        if timeout is None:
+            timeout = self.get_sweep_timeout()
+        end_time = time.time() + timeout
+        while not int(self.inst.query('*ESR?')) & 1:
+            if time.time() > end_time:
+                raise RuntimeError('sweep did not complete within %g s' % timeout)
+            time.sleep(poll)
+    
+    #get number of points per trace.
+    def get_points(self):
+        return int(float(self.inst.query('SENS:SWE:POIN?')))
+    
+    #read the trace at one frequency [MHz] with marker 1, in
+    #one short query instead of downloading the whole trace.
+    #The marker goes to the trace point nearest MHz.
+    def marker_power(self, MHz):
+        return float(self.inst.query('CALC:MARK1:MODE POS;X ' + str(MHz) + ' MHz;Y?'))
+    
     def trace(self):
         freq_center = hp_e4401.get_frequency(self)
         freq_span = hp_e4401.get_span(self)
@@ -1299,15 +1362,15 @@ class tek_5103(object):
     
     #set center frequency [MHz].
     def set_frequency(self, MHz):
-        self.inst.write('SENS:SPEC:FREQ:CENT {}{}'.format(freq, 'MHz'))
+        self.inst.write('SENS:SPEC:FREQ:CENT {}{}'.format(MHz, 'MHz'))
     
     #get span [MHz].
-    def get_span(self)
+    def get_span(self):
         return float(self.inst.query('SENS:SPEC:FREQ:SPAN?')) * 10**-6.0
     
     #set span [MHz].
     def set_span(self, MHz):
-        self.inst.write('SENS:SPEC:FREQ:SPAN {}{}'.format(freq,unit))
+        self.inst.write('SENS:SPEC:FREQ:SPAN {}{}'.format(MHz, 'MHz'))
     
     #show trace (1) or don't (0)
     def set_trace(self, trace):
@@ -1375,7 +1438,7 @@ class tek_5103(object):
     def get_acquisition_samples(self):
         return float(self.inst.query('SENSE:ACQUISITION:SAMPLES?'))
 
-    acquisition_samples = property(get_acq_samples,
+    acquisition_samples = property(get_acquisition_samples,
         set_acquisition_samples,doc=prop_doc('acquisition_samples'))
     
     #set bandwidth [MHz].
@@ -1401,8 +1464,8 @@ class tek_5103(object):
     
     #fetch the current spectrum waveform from trace
     def trace(self, trace=1):
-        freq_center = self.get_frequency(self)
-        freq_span = self.get_span(self)
+        freq_center = self.get_frequency()
+        freq_span = self.get_span()
         freq_min = freq_center - freq_span / 2.0
         freq_max = freq_center + freq_span / 2.0
         
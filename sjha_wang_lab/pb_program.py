@@ -0,0 +1,280 @@
+'''
+pb_program.py
+Programming the SpinCore PulseBlaster through a recorder, so that the
+program on the board is known on the host, and its timing can be
+worked out from the instructions without running it.
+
+Use start_programming(), inst_pbonly() and stop_programming() in place
+of spin.pb_start_programming, spin.pb_inst_pbonly and
+spin.pb_stop_programming. Lengths are in ns (spin.ns == 1).
+
+simulate() runs a program offline: output edges per channel, total
+duration and duty cycles, with loops handled analytically.
+'''
+from collections import namedtuple
+import numpy as np
+
+#Opcodes, same values as in spinapi, so that programs can be
+#handled without the board (or spinapi) being present.
+CONTINUE = 0
+STOP = 1
+LOOP = 2
+END_LOOP = 3
+JSR = 4
+RTS = 5
+BRANCH = 6
+LONG_DELAY = 7
+WAIT = 8
+
+Instruction = namedtuple('Instruction', 'flags opcode data length')
+
+###########################################################
+#Recording
+###########################################################
+
+_recording = None
+
+def start_programming():
+    import spinapi as spin
+    from session import get_session
+    global _recording
+    get_session()
+    spin.pb_start_programming(spin.PULSE_PROGRAM)
+    _recording = []
+
+def inst_pbonly(flags, opcode, data, length):
+    import spinapi as spin
+    index = spin.pb_inst_pbonly(flags, opcode, data, length)
+    _recording.append(Instruction(flags, opcode, data, length))
+    return index
+
+def stop_programming():
+    """
+    Finish programming, and return the program (a tuple of
+    Instructions), which is also kept as the session's loaded_program.
+    """
+    import spinapi as spin
+    from session import get_session
+    global _recording
+    spin.pb_stop_programming()
+    program = tuple(_recording)
+    _recording = None
+    get_session().loaded_program = program
+    return program
+
+###########################################################
+#Program structure and timing
+###########################################################
+
+def _end_loop(program, start):
+    """ index of the END_LOOP closing the LOOP at `start` """
+    for i in range(start + 1, len(program)):
+        if program[i].opcode == END_LOOP and program[i].data == start:
+            return i
+    raise ValueError('LOOP at instruction %d is never closed' % start)
+
+def _block(program, pc, end=None, depth=0):
+    """
+    Walk the program from instruction `pc`, the way the board executes
+    it, but without unrolling loops. Returns (items, next_pc, how):
+
+    - items: list of ('inst', index), ('loop', count, items) and
+      ('call', items), in execution order;
+    - how: 'stop', 'rts', 'end' (reached END_LOOP `end`) or 'branch'
+      (then next_pc is the branch target).
+    """
+    if depth > 32:
+        raise ValueError('loops/subroutines nested too deeply at instruction %d' % pc)
+    items = []
+    loop_start = pc if end is not None else None
+    while True:
+        if not 0 <= pc < len(program):
+            raise ValueError('program runs past its last instruction')
+        inst = program[pc]
+        op = inst.opcode
+
+        if op == LOOP and pc != loop_start:
+            last = _end_loop(program, pc)
+            body, _, how = _block(program, pc, end=last, depth=depth + 1)
+            items.append(('loop', inst.data, body))
+            pc = last + 1
+            continue
+
+        items.append(('inst', pc))
+        if op == STOP:
+            if end is not None:
+                raise ValueError('STOP inside a loop, at instruction %d' % pc)
+            return items, None, 'stop'
+        elif op == RTS:
+            if end is not None:
+                raise ValueError('RTS inside a loop, at instruction %d' % pc)
+            return items, None, 'rts'
+        elif op == END_LOOP:
+            if pc != end:
+                raise ValueError('END_LOOP without LOOP, at instruction %d' % pc)
+            return items, pc + 1, 'end'
+        elif op == JSR:
+            sub, _, how = _block(program, inst.data, depth=depth + 1)
+            if how != 'rts':
+                raise ValueError('subroutine at instruction %d does not return' % inst.data)
+            items.append(('call', sub))
+            pc += 1
+        elif op == BRANCH:
+            if end is not None:
+                raise ValueError('BRANCH inside a loop, at instruction %d' % pc)
+            return items, inst.data, 'branch'
+        else:
+            pc += 1
+
+def instruction_time(inst):
+    """ how long (ns) the board spends on one execution of `inst` """
+    if inst.opcode == STOP:
+        #outputs latch, the program ends
+        return 0.
+    if inst.opcode == LONG_DELAY:
+        return float(inst.length) * inst.data
+    return float(inst.length)
+
+def _items_duration(program, items):
+    total = 0.
+    for item in items:
+        if item[0] == 'inst':
+            total += instruction_time(program[item[1]])
+        elif item[0] == 'loop':
+            total += item[1] * _items_duration(program, item[2])
+        else:
+            total += _items_duration(program, item[1])
+    return total
+
+def program_duration(program):
+    """
+    Total run time (ns) of `program`, from its instructions and loop
+    counts. A program that branches back on itself runs forever, and
+    gives inf. WAIT instructions are counted as not waiting at all.
+    """
+    items, _, how = _block(program, 0)
+    if how == 'branch':
+        return float('inf')
+    return _items_duration(program, items)
+
+###########################################################
+#Offline simulation
+###########################################################
+
+Simulation = namedtuple('Simulation', 'duration endless high duty edges edges_complete')
+
+def _items_count(items):
+    """ number of instructions executed by `items` """
+    total = 0
+    for item in items:
+        if item[0] == 'inst':
+            total += 1
+        elif item[0] == 'loop':
+            total += item[1] * _items_count(item[2])
+        else:
+            total += _items_count(item[1])
+    return total
+
+def _items_high(program, items, masks):
+    """ time (ns) each of `masks` is fully on during `items` """
+    high = np.zeros(len(masks))
+    for item in items:
+        if item[0] == 'inst':
+            inst = program[item[1]]
+            high += instruction_time(inst) * ((inst.flags & masks) == masks)
+        elif item[0] == 'loop':
+            high += item[1] * _items_high(program, item[2], masks)
+        else:
+            high += _items_high(program, item[1], masks)
+    return high
+
+def _items_trace(program, items, first_only=False):
+    """
+    Start time, length and flags of every instruction executed by
+    `items`, as arrays, and the total duration. Loops are expanded by
+    tiling the body, not one iteration at a time. With `first_only`,
+    only the first iteration of each loop is traced (the time still
+    advances by the whole loop).
+    """
+    starts, lengths, flags = [], [], []
+    t = 0.
+    for item in items:
+        if item[0] == 'inst':
+            inst = program[item[1]]
+            length = instruction_time(inst)
+            starts.append(np.array([t]))
+            lengths.append(np.array([length]))
+            flags.append(np.array([inst.flags], dtype=np.int64))
+            t += length
+        else:
+            body = item[2] if item[0] == 'loop' else item[1]
+            count = item[1] if item[0] == 'loop' else 1
+            s, l, f, d = _items_trace(program, body, first_only)
+            offsets = t + d * np.arange(1 if first_only else count)
+            starts.append((offsets[:, None] + s[None, :]).ravel())
+            lengths.append(np.tile(l, len(offsets)))
+            flags.append(np.tile(f, len(offsets)))
+            t += count * d
+    if not starts:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), 0.
+    return np.concatenate(starts), np.concatenate(lengths), np.concatenate(flags), t
+
+def simulate(program, masks=None, edges='auto', max_instructions=10**7):
+    """
+    Run `program` offline. `masks` is a dict of channel name: output
+    bits (a channel is on when all its bits are); by default, every
+    output bit that the program uses, by bit number.
+
+    Returns a Simulation with:
+    - duration: run time (ns), or the period if `endless` (the program
+      branches back and repeats forever);
+    - high, duty: dicts of on time (ns) and duty cycle per channel,
+      worked out from the loop counts without expanding the loops;
+    - edges: dict of channel: (times, levels) arrays, every time the
+      channel switches and the level it switches to. Outputs start
+      low. edges=True traces every executed instruction, and raises
+      for more than `max_instructions`; edges='first' traces only the
+      first iteration of each loop (the edges after it are shifted by
+      the time the rest of the loop takes); edges='auto' (the default)
+      is True if the program fits in `max_instructions`, else 'first';
+      edges=False skips them;
+    - edges_complete: whether `edges` has every edge of the run.
+    """
+    items, _, how = _block(program, 0)
+    endless = how == 'branch'
+
+    if masks is None:
+        used = 0
+        for inst in program:
+            used |= inst.flags
+        masks = dict((bit, 1 << bit) for bit in range(used.bit_length())
+                     if used >> bit & 1)
+    names = list(masks)
+    mask_arr = np.array([masks[name] for name in names], dtype=np.int64)
+
+    duration = _items_duration(program, items)
+    high_arr = _items_high(program, items, mask_arr)
+    high = dict(zip(names, high_arr))
+    duty = dict((name, high[name] / duration if duration else 0.)
+                for name in names)
+
+    channel_edges = None
+    first_only = edges == 'first'
+    if edges and not first_only:
+        count = _items_count(items)
+        if count > max_instructions:
+            if edges != 'auto':
+                raise ValueError('program executes %d instructions; use '
+                                 "edges='first' or raise max_instructions" % count)
+            first_only = True
+    if edges:
+        starts, _, flags, _ = _items_trace(program, items, first_only)
+        channel_edges = {}
+        for name, mask in zip(names, mask_arr):
+            level = ((flags & mask) == mask).astype(np.int8)
+            before = np.concatenate(([0], level[:-1]))
+            switch = level != before
+            channel_edges[name] = (starts[switch], level[switch])
+
+    return Simulation(duration, endless, high, duty, channel_edges,
+                      bool(edges) and not first_only)
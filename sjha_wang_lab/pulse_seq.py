@@ -0,0 +1,347 @@
+'''
+pulse_seq.py
+Pulse sequences for the SpinCore PulseBlaster, described by channel
+name and duration instead of hand-written pb_inst_pbonly calls, and
+compiled into instruction lists (see pb_program.py).
+
+Compiled programs are cached, and upload() skips programming the
+board when it already holds an identical program. simulate_sequence()
+checks a sequence's timing offline, without the board.
+
+Example, the sequence of expt_supp.rabi_pulse:
+
+>>>from pulse_seq import pulse, loop, call, sequence, compile_sequence, upload
+>>>
+>>>seq = sequence([call('rabi', 2300, 'green'),
+...                pulse(650)],
+...               subroutines=dict(rabi=[
+...                   loop(500000,
+...                        pulse(5500 - mw),
+...                        pulse(mw, 'mw'),
+...                        pulse(650, 'green'),
+...                        pulse(300, 'detection'),
+...                        pulse(2300, 'green')),
+...                   pulse(2300, 'green')]))
+>>>upload(compile_sequence(seq))
+
+Measurement families (rabi, ramsey, t1, echo) are built by
+sweep_sequence(): one program for a whole sweep of the delay (or
+pulse width), with reference blocks for normalization.
+'''
+import warnings
+from collections import namedtuple
+import pb_program as pb
+
+###########################################################
+#Board and channels
+###########################################################
+
+CLOCK = 500       #core clock, MHz
+MIN_CYCLES = 5    #shortest instruction, in clock cycles
+MAX_LOOP = 2**20  #largest loop count the board takes
+
+#Bits that are always set (the short-pulse control bits).
+BASE_FLAGS = 0b111000000000000000000000
+
+#Output bit(s) for each channel name. Make sure these match up with
+#the spincore card channels. 'detection' is green with the gate;
+#'marker' tags the end of a block for buffered counting.
+CHANNELS = dict(green=0b1,
+                gate=0b10,
+                detection=0b11,
+                mw2=0b100,
+                mw=0b1000,
+                mw1=0b1000,
+                marker=0b10000)
+
+###########################################################
+#Describing sequences
+###########################################################
+
+Pulse = namedtuple('Pulse', 'length channels')
+Loop = namedtuple('Loop', 'count body')
+Call = namedtuple('Call', 'name length channels')
+Sequence = namedtuple('Sequence', 'main subroutines end')
+
+def pulse(length, *channels):
+    """
+    `length` ns with the given channels on (names from CHANNELS, or
+    flag words as in expt_supp.pulse_dict), all others off.
+    Zero-length pulses are left out of the program.
+    """
+    return Pulse(length, tuple(channels))
+
+def loop(count, *body):
+    """
+    repeat `body` `count` times. Counts above MAX_LOOP are compiled
+    into nested loops, so any count runs on the board in one go.
+    """
+    return Loop(int(count), tuple(body))
+
+def call(name, length, *channels):
+    """
+    call the subroutine `name`, after `length` ns with the given
+    channels on (the JSR instruction itself has a length)
+    """
+    return Call(name, length, tuple(channels))
+
+def sequence(main, subroutines=None, end='stop'):
+    """
+    A whole program: the `main` items, then the `subroutines` (a dict
+    of name: items). The last item of main stops the board
+    (end='stop') or jumps back to the start (end='branch'); the last
+    item of each subroutine returns from it.
+    """
+    if end not in ('stop', 'branch'):
+        raise ValueError("end must be 'stop' or 'branch'")
+    subroutines = tuple(sorted((name, tuple(items))
+                               for name, items in (subroutines or {}).items()))
+    return Sequence(tuple(main), subroutines, end)
+
+###########################################################
+#Compiling
+###########################################################
+
+def _flags(channels, channel_map):
+    flags = BASE_FLAGS
+    for channel in channels:
+        if isinstance(channel, str):
+            try:
+                flags |= channel_map[channel]
+            except KeyError:
+                raise ValueError('unknown channel %r' % channel)
+        else:
+            flags |= int(channel)
+    return flags
+
+def _length(length, clock):
+    """ check `length` (ns) against the clock, and round it to cycles """
+    period = 1000.0 / clock
+    cycles = length / period
+    if length < 0:
+        raise ValueError('negative pulse length %s ns' % length)
+    if 0 < cycles < MIN_CYCLES:
+        raise ValueError('pulse length %s ns is shorter than %d clock cycles'
+                         % (length, MIN_CYCLES))
+    if abs(cycles - round(cycles)) > 1e-6:
+        warnings.warn('pulse length %s ns rounded to the %g ns clock period'
+                      % (length, period))
+    return round(cycles) * period
+
+def _set_opcode(insts, index, opcode, data, what):
+    if insts[index][1] != pb.CONTINUE:
+        raise ValueError('%s would share instruction %d with another LOOP, '
+                         'END_LOOP or call; add a pulse around it' % (what, index))
+    insts[index][1] = opcode
+    insts[index][2] = data
+
+def _split_loop(item):
+    """
+    Items repeating item.body item.count (> MAX_LOOP) times, using
+    loops of at most MAX_LOOP each. The outer loop repeats
+    body, loop(MAX_LOOP - 2, body), body: the copies of the body give
+    the outer LOOP and END_LOOP instructions of their own, so the
+    timing is exactly that of the unrolled loop, with no padding.
+    Outer counts above MAX_LOOP are split again when emitted.
+    """
+    outer, rest = divmod(item.count, MAX_LOOP)
+    items = [Loop(outer, item.body + (Loop(MAX_LOOP - 2, item.body),) + item.body)]
+    if rest:
+        items.append(Loop(rest, item.body))
+    return items
+
+def _emit(items, insts, channel_map, clock):
+    """ append the instructions for `items` to `insts` """
+    for item in items:
+        if isinstance(item, Pulse):
+            length = _length(item.length, clock)
+            if length:
+                insts.append([_flags(item.channels, channel_map),
+                              pb.CONTINUE, 0, length])
+        elif isinstance(item, Call):
+            insts.append([_flags(item.channels, channel_map),
+                          pb.JSR, item.name, _length(item.length, clock)])
+        elif isinstance(item, Loop):
+            if item.count < 1:
+                raise ValueError('loop count %d is less than 1' % item.count)
+            if item.count > MAX_LOOP:
+                _emit(_split_loop(item), insts, channel_map, clock)
+                continue
+            first = len(insts)
+            _emit(item.body, insts, channel_map, clock)
+            last = len(insts) - 1
+            if last <= first:
+                raise ValueError('a loop needs at least two instructions')
+            _set_opcode(insts, first, pb.LOOP, item.count, 'LOOP')
+            _set_opcode(insts, last, pb.END_LOOP, first, 'END_LOOP')
+        else:
+            raise TypeError('unknown sequence item %r' % (item,))
+
+_programs = {}
+
+def compile_sequence(seq, channel_map=CHANNELS, clock=CLOCK):
+    """
+    Compile `seq` (from sequence()) into a program: a tuple of
+    pb_program.Instruction. Programs are cached, so compiling the
+    same sequence again is free.
+    """
+    key = (seq, tuple(sorted(channel_map.items())), clock)
+    if key in _programs:
+        return _programs[key]
+
+    insts = []
+    _emit(seq.main, insts, channel_map, clock)
+    if not insts:
+        raise ValueError('empty sequence')
+    if seq.end == 'stop':
+        _set_opcode(insts, len(insts) - 1, pb.STOP, 0, 'STOP')
+    else:
+        _set_opcode(insts, len(insts) - 1, pb.BRANCH, 0, 'BRANCH')
+
+    addresses = {}
+    for name, items in seq.subroutines:
+        addresses[name] = len(insts)
+        start = len(insts)
+        _emit(items, insts, channel_map, clock)
+        if len(insts) == start:
+            raise ValueError('empty subroutine %r' % name)
+        _set_opcode(insts, len(insts) - 1, pb.RTS, 0, 'RTS')
+
+    for inst in insts:
+        if inst[1] == pb.JSR:
+            try:
+                inst[2] = addresses[inst[2]]
+            except KeyError:
+                raise ValueError('no subroutine named %r' % inst[2])
+
+    program = tuple(pb.Instruction(*inst) for inst in insts)
+    if len(_programs) > 1000:
+        _programs.clear()
+    _programs[key] = program
+    return program
+
+def upload(program):
+    """
+    Write `program` to the board, unless it is already there.
+    Returns whether the board was programmed.
+    """
+    from session import get_session
+    if get_session().loaded_program == program:
+        return False
+    pb.start_programming()
+    for inst in program:
+        pb.inst_pbonly(*inst)
+    pb.stop_programming()
+    return True
+
+def simulate_sequence(seq, channel_map=CHANNELS, edges='auto'):
+    """
+    Compile `seq` and run it offline (see pb_program.simulate), with
+    the timelines and duty cycles reported by channel name.
+    """
+    program = compile_sequence(seq, channel_map)
+    return pb.simulate(program, masks=dict(channel_map), edges=edges)
+
+###########################################################
+#Measurement families
+###########################################################
+
+#What happens between initialization and readout, for each family,
+#as a function of the swept value `x` (ns). pi_time is the length of
+#the microwave pi pulse.
+
+def _rabi(x, pi_time=None):
+    """ microwave pulse of width x """
+    return (pulse(x, 'mw'),)
+
+def _ramsey(x, pi_time):
+    """ free precession for x between two pi/2 pulses """
+    return (pulse(pi_time / 2., 'mw'), pulse(x), pulse(pi_time / 2., 'mw'))
+
+def _t1(x, pi_time=None):
+    """ relaxation for x, after a pi pulse if pi_time is given """
+    return (pulse(pi_time or 0, 'mw'), pulse(x))
+
+def _echo(x, pi_time):
+    """ Hahn echo: pi/2, x, pi, x, pi/2 (x is the delay on each side) """
+    return (pulse(pi_time / 2., 'mw'), pulse(x), pulse(pi_time, 'mw'),
+            pulse(x), pulse(pi_time / 2., 'mw'))
+
+FAMILIES = dict(rabi=_rabi, ramsey=_ramsey, t1=_t1, echo=_echo)
+
+def readout(green_time=2300, det_time=300, off_time=650):
+    """
+    Detection and re-initialization, as in expt_supp.rabi_pulse: off_time
+    accounts for the delay of the green AOM, and the detection window
+    opens as the green arrives.
+    """
+    return (pulse(off_time, 'green'),
+            pulse(det_time, 'detection'),
+            pulse(green_time, 'green'))
+
+def _items_length(items):
+    return sum(item.length for item in items)
+
+def _sweep_blocks(family, values, pi_time, references):
+    """ the family's pulses for each value, and the reference blocks """
+    try:
+        manipulate = FAMILIES[family]
+    except KeyError:
+        raise ValueError('unknown family %r (known: %s)'
+                         % (family, ', '.join(sorted(FAMILIES))))
+    if family in ('ramsey', 'echo') and pi_time is None:
+        raise ValueError('the %s family needs pi_time' % family)
+    if references and pi_time is None:
+        raise ValueError('the reference blocks need pi_time')
+    blocks = [manipulate(x, pi_time) for x in values]
+    refs = [(), (pulse(pi_time, 'mw'),)] if references else []
+    return blocks, refs
+
+def sweep_period(family, values, pi_time=None, references=False,
+                 green_time=2300, det_time=300, off_time=650):
+    """
+    The default period of sweep_sequence: the longest block plus
+    100 ns. Give it to each call when a sweep is split over several
+    programs, so they all have the same duty cycle.
+    """
+    blocks, refs = _sweep_blocks(family, values, pi_time, references)
+    longest = max(_items_length(b) for b in blocks + refs)
+    return longest + _items_length(readout(green_time, det_time, off_time)) + 100
+
+def sweep_sequence(family, values, loop_num=500000, pi_time=None,
+                   references=False, period=None, green_time=2300,
+                   det_time=300, off_time=650, marker_time=100):
+    """
+    One program sweeping `values` (ns) of a measurement `family`
+    (a name in FAMILIES). For each value, a loop of `loop_num` blocks:
+    pad, the family's pulses, readout(); then a pulse on the 'marker'
+    channel, so that buffered counters clocked by the marker bin the
+    counts per value (see expt_supp.gen_sweep_batched).
+
+    The pad makes every block last `period` ns, so the duty cycle does
+    not depend on the value. By default the period is the longest
+    block plus 100 ns (see sweep_period).
+
+    With `references`, each value is followed by two reference loops,
+    each with its own marker: readout with no microwaves (bright, m=0)
+    and after a pi pulse (dark, m=1), for normalizing out drifts.
+    """
+    blocks, refs = _sweep_blocks(family, values, pi_time, references)
+    ro = readout(green_time, det_time, off_time)
+    longest = max(_items_length(b) for b in blocks + refs)
+    if period is None:
+        period = longest + _items_length(ro) + 100
+    pad = period - _items_length(ro)
+    if longest > pad:
+        raise ValueError('a block (%s ns) is longer than the period (%s ns)'
+                         % (longest + _items_length(ro), period))
+
+    main = [pulse(green_time, 'green')] #initialization for the first loop
+    for block in blocks:
+        for items in [block] + refs:
+            main.append(loop(loop_num,
+                             pulse(pad - _items_length(items)),
+                             *(items + ro)))
+            main.append(pulse(marker_time, 'green', 'marker')) #end of this bin
+    main.append(pulse(off_time))
+    return sequence(main)
@@ -8,6 +8,10 @@ from contextlib import contextmanager
 #for functions to support Rabi oscillation scans
 import numpy as np
 import spinapi as spin
+import expt
+from expt import make_gated_counters, read_gated_block
+from session import get_session, close_session
+from pulse_seq import pulse, loop, call, sequence, compile_sequence, upload
 #from wanglib.util import scanner
 #from wanglib.pylab_extensions import plotgen
 #from functools import partial
@@ -17,193 +21,176 @@ import spinapi as spin
 ### COUNTING
 ### -------------------------------------------------------
 
-def make_counter(countchan, trig=None):
-    """
-    Configure the given counter to count, maybe with a pause trigger.
-    """
-    ctr = daq.Task()
-    ctr.CreateCICountEdgesChan(countchan, "",
-                               daq.DAQmx_Val_Rising,
-                               0,  # initial count
-                               daq.DAQmx_Val_CountUp)
+# The counting itself is in acquisition.py, shared with expt.py and
+# expt_supp.py; the channels here are those of the Fusion setup
+# profile.
+from acquisition import (make_counter, make_pulse, start_count,
+                         finish_count, do_count, counting, get_counts,
+                         commit)
 
-    if trig is not None:
-        # configure pause trigger
-        ctr.SetPauseTrigType(daq.DAQmx_Val_DigLvl)
-        ctr.SetDigLvlPauseTrigSrc(trig)
-        ctr.SetDigLvlPauseTrigWhen(daq.DAQmx_Val_Low)
+def configure_counter(duration=.1, profile='fusion', **channels):
+    """ expt.configure_counter, for the Fusion setup """
+    return expt.configure_counter(duration, profile=profile, **channels)
 
-    return ctr
+def scan(gen, t=0.1, profile='fusion', **kwargs):
+    """ expt.scan, for the Fusion setup """
+    return expt.scan(gen, t=t, profile=profile, **kwargs)
 
-def make_pulse(duration, pulsechan):
-    """
-    Configure the counter `pulsechan` to output
-    a pulse of the given `duration` (in seconds).
-    """
-    pulse = daq.Task()
-    pulse.CreateCOPulseChanTime(
-        pulsechan, "",            # physical channel, name to assign
-        daq.DAQmx_Val_Seconds,   # units:seconds
-        daq.DAQmx_Val_Low,       # idle state: low
-        0.00, .0001, duration,   # initial delay, low time, high time
-    )
-    return pulse
+def gen_count_rate(t=0.1, profile='fusion', **kwargs):
+    """ expt.gen_count_rate, for the Fusion setup """
+    return expt.gen_count_rate(t=t, profile=profile, **kwargs)
 
-def configure_counter(duration=.1,
-                      pulsechan="Dev1/ctr1",
-                      countchan="Dev1/ctr0"):
+def gen_gated_counts(t=0.1, n=1, profile='fusion'):
     """
-    Configure the card to count edges on `countchan`, for the specified
-    `duration` of time (seconds). This is a hardware-timed thing,
-    using the paired counter `pulsechan` to gate the detection
+    equivalent of gen_count_rate when something else (e.g. a spincore
+    sequence) is gating the detection, not a pulse we generate
+    ourselves.
+    
+    This counts both photons and gate edges, and returns the rate as
+    photons collected per gated detection period. Divide by the width
+    of the window to get counts per second.
+    
+    The window is timed by the card, and both counters are armed by
+    the same trigger (see acquisition.make_gated_counters). With `n` > 1 each
+    step yields `n` back-to-back windows as arrays instead.
     """
+    # the channels are those of the setup `profile` (see acquisition.py)
+    clk, pc, gc = make_gated_counters(t, n, profile=profile)
+    
+    start = time.time()
+    while True:
+        t0 = time.time() - start
+        photons, pulses = read_gated_block(clk, pc, gc, n,
+                                           timeout=n * t + 10.)
+        rate = np.where(pulses > 0, photons, 0.)
+        if n == 1:
+            yield t0 + t, rate[0]
+        else:
+            yield t0 + t * np.arange(1, n + 1), rate
 
-    # configure pulse (for hardware timing)
-    pulse = make_pulse(duration, pulsechan)
-
-    # if these are paired counters, we can use the internal output
-    # of the pulsing channel to trigger the counting channel
-    trigchan = "/%sInternalOutput" % pulsechan.replace('ctr', 'Ctr')
-
-    # configure counter
-    ctr = make_counter(countchan, trig=trigchan)
-
-    return pulse, ctr
-
-def start_count(pulse, ctr):
-    """ start counting events. """
-    # start counter
-    ctr.StartTask()
-    # fire pulse
-    pulse.StartTask()
-    return
+class GatedCounter(object):
+    """
+    Gated counting for one window at a time, e.g. one per scan point,
+    without reconfiguring the card each time: the photon, gate and
+    clock tasks (see acquisition.make_gated_counters) are set up and
+    committed once (and released by close()), and count() only
+    re-arms them.
 
-def finish_count(pulse, ctr):
-    """ finish counting events and return the result. """
-    # initialize memory for readout
-    count = uInt32()
-    # wait for pulse to be done
-    pulse.WaitUntilTaskDone(10.)
-    # timeout, ref to output value, reserved
-    ctr.ReadCounterScalarU32(10., byref(count), None)
-    pulse.StopTask()
-    ctr.StopTask()
-    return count.value
+    The time spent arming, reading (which includes the `t` s window
+    itself) and stopping is recorded for every count; timing() gives
+    the means, and the overhead per point on top of the window.
 
-def do_count(pulse, ctr):
-    """
-    simple counting in a synchronous mode
+    Keep one per session with get_gated_counter(), and free its
+    counters for other tasks with release_gated_counter() (or by
+    closing the session).
     """
-    start_count(pulse, ctr)
-    return finish_count(pulse, ctr)
+    def __init__(self, t=0.1, profile='fusion', **channels):
+        # the channels are those of the setup `profile`, unless given
+        self.t = t
+        # committed here, so re-arming them is cheap; close() frees them
+        self.clk, self.pc, self.gc = make_gated_counters(
+            t, 1, profile=profile, **channels)
+        commit(self.pc, self.gc, self.clk)
+        self._latched = np.zeros(1, dtype=np.uint32)
+        self._read = int32()
+        self.reset_timing()
 
-@contextmanager
-def counting(pulse, ctr):
-    try:
-        yield
-    except KeyboardInterrupt:
-        # stop the counters
-        try:
-            ctr.StopTask()
-            print("stopped counter")
-        except daq.DAQError:
-            print("no need to stop counter")
-        try:
-            pulse.StopTask()
-            print("stopped timer")
-        except daq.DAQError:
-            print("no need to stop timer")
-        raise
+    def reset_timing(self):
+        self.n = 0
+        self.arm_time = 0.
+        self.read_time = 0.
+        self.stop_time = 0.
 
-def scan(gen, t=0.1, **kwargs):
-    """threaded version"""
-    p,c = configure_counter(duration=t, **kwargs)
-    with counting(p,c):
-        next(gen)
+    def count(self, timeout=None):
+        """ count one window, and return (photons, gate edges) """
+        if timeout is None:
+            timeout = self.t + 10.
+        t0 = time.time()
+        self.pc.StartTask()
+        self.gc.StartTask()
+        self.clk.StartTask()
+        t1 = time.time()
         try:
-            last = do_count(p,c)/t
-        except daq.DAQError as e:
-            print(str(e), sys.stderr)#formerly file=sys.stderr
-            raise StopIteration
-        for step in gen:
-            start_count(p, c)
-            yield last
-            last = finish_count(p, c)/t
-        yield last
+            counts = []
+            for ctr in (self.pc, self.gc):
+                ctr.ReadCounterU32(1, timeout, self._latched, 1,
+                                   byref(self._read), None)
+                counts.append(int(self._latched[0]))
+            t2 = time.time()
+        finally:
+            self.clk.StopTask()
+            self.gc.StopTask()
+            self.pc.StopTask()
+        t3 = time.time()
 
-def gen_count_rate(t=0.1, **kwargs):
-    p,c = configure_counter(duration=t, **kwargs)
-    start = time.time()
-    while True:
-        y = do_count(p,c)/t
-        yield time.time() - start, y
+        self.n += 1
+        self.arm_time += t1 - t0
+        self.read_time += t2 - t1
+        self.stop_time += t3 - t2
+        photons, gates = counts
+        return photons, gates
 
-def get_counts(ctr):
-    """ this stops ``ctr`` and returns its result """
-    count = daq.uInt32()
-    ctr.ReadCounterScalarU32(10., daq.byref(count), None)
-    ctr.StopTask()
-    return count.value
+    def timing(self):
+        """
+        Mean arm, read and stop times per count (s), and the overhead:
+        everything but the counting window itself.
+        """
+        if not self.n:
+            return {}
+        arm = self.arm_time / self.n
+        read = self.read_time / self.n
+        stop = self.stop_time / self.n
+        return dict(arm=arm, read=read, stop=stop,
+                    overhead=arm + read + stop - self.t)
 
-def gen_gated_counts(t=0.1):
+    def close(self):
+        for task in (self.clk, self.gc, self.pc):
+            task.ClearTask()
+
+def get_gated_counter(t=0.1):
     """
-    equivalent of gen_count_rate when something else (e.g. a spincore
-    sequence) is gating the detection, not a pulse we generate
-    ourselves.
-    
-    This counts both photons and gate edges, and returns the rate as
-    photons collected per gated detection period. Divide by the width
-    of the window to get counts per second.
+    the session's GatedCounter for windows of `t` s. There is only one,
+    since its tasks keep the counters reserved: asking for another `t`
+    closes the old one first.
     """
-    # photon counter
-    pc = make_counter("Dev1/ctr0", trig="PFI38")
-    # and the gate counter:
-    gc = make_counter("Dev1/ctr3")
-    # the paths here are for Fusion setup, hardcoded for now (sorry)
-    
-    start = time.time()
-    while True:
-        gc.StartTask() # start both counters. this isn't
-        pc.StartTask() # exactly synchronous (error source)
-        time.sleep(t)
-        photons = get_counts(pc)
-        pulses  = get_counts(gc)
-        if pulses:
-            rate = photons 
-        else:
-            rate = 0.
-        yield time.time() - start, rate
+    session = get_session()
+    counter = session.resources.get('gated_counter')
+    if counter is not None and counter.t != t:
+        session.release('gated_counter')
+    return session.resource('gated_counter', lambda: GatedCounter(t))
+
+def release_gated_counter():
+    """ close the session's GatedCounter, freeing its counters """
+    get_session().release('gated_counter')
 
 def do_count_v2(t):
-    gen = gen_gated_counts(t=t)
-    _,rate = next(gen)
-    return rate
+    """
+    photons in one gated window of `t` s, from the session's
+    GatedCounter (0 if the gate never opened)
+    """
+    photons, gates = get_gated_counter(t).count()
+    return photons if gates > 0 else 0.
 
 ### -------------------------------------------------------
 ### Support for Rabi oscillation scans
 ### -------------------------------------------------------
 
+# The board is initialized by the process-wide session (see
+# session.py), not on import. initialize() and close() are kept for
+# the scans that call them explicitly.
 def initialize():
-    if spin.pb_init() != 0:
-        print ("Error initializing board: %s" % spin.pb_get_error())
-        input("Please press any key to continue.")
-        exit(-1)
-    else:
-        spin.pb_core_clock(500)
+    get_session()
 
 def on():
+    get_session()
     spin.pb_start()
         
 def stop():
+    get_session()
     spin.pb_stop()
     
 def close():
-    spin.pb_close()
-
-# Pretty much always initialize and close at the beginning,
-# so might as well just do that here.
-initialize() 
-close()
+    close_session()
 
 # Define the channels that will be used. 
 onn = 0b111000000000000000001011
@@ -250,23 +237,23 @@ def rabi_seq(mw_t, det_t=400, off_t=3040, green_t=5000, duty_t=5000, wait_t=0, l
     #and to be at beginning of green pulse, which has a delay of off_t due to AOM.
     delay_2 = (off_t - mw_t - wait_t) 
     
-    spin.pb_start_programming(spin.PULSE_PROGRAM)
-    
-    start = spin.pb_inst_pbonly(grn, spin.JSR, 2, green_t)
-    spin.pb_inst_pbonly(off, spin.STOP, 0, 500)
-    
-    sub = spin.pb_inst_pbonly(off, spin.LOOP, loop_num, delay_1) # then wait.
-    spin.pb_inst_pbonly(grn, spin.CONTINUE, 0, delay_2) # then green pulse. Will hit just as detector turns on.
-    spin.pb_inst_pbonly(mw1g, spin.CONTINUE, 0, mw_t) # think of this as beginning. MW pulse.
-    #spin.pb_inst_pbonly(mw1, spin.CONTINUE, 0, mw_t) # think of this as beginning. MW pulse. Results in green gap that limits possible detection time.
-    spin.pb_inst_pbonly(offg, spin.CONTINUE, 0, wait_t) # then wait
-    #spin.pb_inst_pbonly(off, spin.CONTINUE, 0, wait_t) # then wait. Results in green gap that limits possible detection time.
-    spin.pb_inst_pbonly(det, spin.CONTINUE, 0, det_t) # then detection pulse (green has just hit by now). Back to top.
-    spin.pb_inst_pbonly(grn, spin.END_LOOP, sub, green_t)
-    
-    spin.pb_inst_pbonly(off, spin.RTS, 0, 500)
+    seq = sequence(
+        [call('rabi', green_t, 'green'),
+         pulse(500)],
+        subroutines=dict(rabi=[
+            loop(loop_num,
+                 pulse(delay_1), # then wait.
+                 pulse(delay_2, 'green'), # then green pulse. Will hit just as detector turns on.
+                 pulse(mw_t, 'mw1', 'green'), # think of this as beginning. MW pulse.
+                 #pulse(mw_t, 'mw1'), # think of this as beginning. MW pulse. Results in green gap that limits possible detection time.
+                 pulse(wait_t, 'green'), # then wait
+                 #pulse(wait_t), # then wait. Results in green gap that limits possible detection time.
+                 pulse(det_t, 'detection'), # then detection pulse (green has just hit by now). Back to top.
+                 pulse(green_t, 'green')),
+            pulse(500)]))
     
-    spin.pb_stop_programming()
+    #cached, and only written to the board when it changes
+    upload(compile_sequence(seq))
 
 def rabi_start(mw_t, det_t=400, off_t=3000, green_t=5000, duty_t=5000, wait_t=0, loop_num=1000000):
     rabi_seq(mw_t, det_t=det_t, off_t=off_t, green_t=green_t, duty_t=duty_t, wait_t=wait_t, loop_num=loop_num)
@@ -0,0 +1,72 @@
+'''
+ring_buffer.py
+Fixed-size NumPy ring buffer, for streams of counts and time tags
+that should not grow without bound.
+'''
+import numpy as np
+
+class RingBuffer(object):
+    """
+    Ring buffer holding the last `size` values written to it.
+
+    Every value is stored twice, `size` elements apart, so the latest
+    values are always one contiguous slice of the underlying array:
+    view() never has to copy, no matter where the write position is.
+
+    >>>rb = RingBuffer(1000)
+    >>>rb.extend(np.arange(1500))
+    >>>rb.view(3)
+    array([ 1497.,  1498.,  1499.])
+    """
+    def __init__(self, size, dtype=float):
+        self.size = int(size)
+        self._data = np.zeros(2 * self.size, dtype=dtype)
+        self._head = 0   # where the next value goes, in [0, size)
+        self.count = 0   # number of values ever written
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def append(self, value):
+        self._data[self._head] = value
+        self._data[self._head + self.size] = value
+        self._head = (self._head + 1) % self.size
+        self.count += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.dtype).ravel()
+        n = len(values)
+        if n == 0:
+            return
+        if n > self.size:
+            # only the last `size` values survive anyway
+            self._head = (self._head + n - self.size) % self.size
+            self.count += n - self.size
+            values = values[-self.size:]
+            n = self.size
+        idx = (self._head + np.arange(n)) % self.size
+        self._data[idx] = values
+        self._data[idx + self.size] = values
+        self._head = (self._head + n) % self.size
+        self.count += n
+
+    def view(self, n=None):
+        """
+        The last `n` values (all of them by default), oldest first, as
+        a read-only view into the buffer. It is only valid until the
+        next write.
+        """
+        if n is None or n > len(self):
+            n = len(self)
+        end = self._head + self.size
+        out = self._data[end - n:end]
+        out.flags.writeable = False
+        return out
+
+    def clear(self):
+        self._head = 0
+        self.count = 0
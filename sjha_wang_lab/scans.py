@@ -1,6 +1,7 @@
 '''
 scans.py
-Commonly used scans.
+Commonly used scans. Each is a configuration of the sweep engine in
+sweep.py: its axes, detectors, and the plot and save sinks.
 '''
 
 '''
@@ -34,6 +35,102 @@ rabi_osc_scan(generator, power_dBm, freq,
             overlay=False)
 '''
 
+#Settle modes for the analyzer scans:
+#    'pause': wait `pause` s after each step, and read whatever trace
+#             the (continuously sweeping) analyzer shows.
+#    'opc':   single sweep mode; after each step take one fresh sweep
+#             and wait for it with INIT;*OPC?, so the bus is held for
+#             just one sweep time.
+#    'poll':  as 'opc', but poll the operation complete bit (*ESR?).
+SETTLE_MODES = ('pause', 'opc', 'poll')
+
+#Readouts for the analyzer scans:
+#    'trace':  download the whole trace, and take the point nearest
+#              the frequency (needed to save the traces).
+#    'marker': put a marker on the frequency and read just its value.
+READOUTS = ('trace', 'marker')
+
+#Setter and getter for the sweeps in analyzer_scan and
+#generator_analyzer_scan: tune the analyzer, and read the power at
+#that frequency from its trace. With save_trace, every trace is saved
+#in a directory named after the scan's start time, by `writer` (a
+#sweep.AsyncWriter, off the readout thread) if given.
+def _analyzer_reading(analyzer, parameters, start_time, save_trace=False,
+                      settle='pause', sweep_timeout=None, readout=None,
+                      writer=None):
+    import numpy as np
+    import os
+    import time
+    from general_tools import save_array
+    
+    #Directory for saved traces
+    trace_dir = time.strftime('scans/%Y-%m-%d-%H-%M-%S_trace', time.localtime(start_time))
+    if save_trace:
+        try:
+            os.mkdir('scans')
+        except:
+            #print('could not make one of the directories')
+            pass
+        try:
+            os.mkdir(trace_dir)
+        except:
+            #print('could not make one of the directories')
+            pass
+    
+    if settle not in SETTLE_MODES:
+        raise ValueError('settle must be one of %s' % (SETTLE_MODES,))
+    if readout is None:
+        readout = 'trace' if save_trace else 'marker'
+    if readout not in READOUTS:
+        raise ValueError('readout must be one of %s' % (READOUTS,))
+    if save_trace and readout != 'trace':
+        raise ValueError("save_trace needs readout='trace'")
+    
+    parameters.insert(-1, ['Readout', readout])
+    if readout == 'marker':
+        parameters[-1][1] = str(analyzer.get_points())
+    
+    #the sweep time only changes with span and bandwidth, which are
+    #set for the whole scan: query it once, not at every point
+    if settle != 'pause' and sweep_timeout is None:
+        sweep_timeout = analyzer.get_sweep_timeout()
+    
+    current = {}
+    
+    def set_freq(freq):
+        analyzer.set_frequency(freq)
+        current['freq'] = freq
+    
+    def read_power():
+        freq = current['freq']
+        if settle == 'opc':
+            analyzer.sweep(timeout=sweep_timeout)
+        elif settle == 'poll':
+            analyzer.start_sweep()
+            analyzer.wait_sweep(timeout=sweep_timeout)
+        if readout == 'marker':
+            return analyzer.marker_power(freq)
+        
+        readings = analyzer.trace()
+        #nearest point: the trace frequencies are worked out from
+        #center and span, so are rarely exactly equal to freq
+        readings_ind = np.argmin(np.abs(readings[0] - freq))
+        value = readings[1, readings_ind]
+        
+        #Save all traces
+        if save_trace:
+            trace_file = trace_dir + '/' + str(freq) + '.txt'
+            if writer is not None:
+                writer.write_array(trace_file, np.transpose(readings), delimiter=',')
+            else:
+                save_array(trace_file, np.transpose(readings), delimiter=',')
+        
+        #Data points per trace
+        parameters[-1][1] = str(len(readings[0]))
+        return value
+    
+    return set_freq, read_power
+
 #Instruments:
 #    HP E4401 spectrum analyzer.
 #Scan HP E4401, and record trace for each frequency.
@@ -42,9 +139,20 @@ def analyzer_scan(analyzer,
                 freq_min, freq_max, freq_step,
                 ref_level=-63.0, span=30, bandwidth=0.01,
                 init_pause=5.0, pause=1.0,
-                plot=False, save_trace=False):
+                plot=False, save_trace=False,
+                settle='pause', sweep_timeout=None, readout=None):
     '''
     Requires class hp_e4401 from instruments.py.
+    
+    settle: 'pause' waits `pause` s after each frequency step. 'opc' or
+    'poll' instead take one fresh analyzer sweep per step and wait
+    exactly until it is complete (see SETTLE_MODES); `pause` is then
+    not used. sweep_timeout (s) defaults to twice the analyzer sweep
+    time plus 1 s.
+    
+    readout: 'marker' reads only the power at each frequency, with a
+    marker; 'trace' downloads the whole trace each time. Defaults to
+    'trace' with save_trace, 'marker' otherwise.
     Example: initialize as and use as...
     
     >>>#Initialization...
@@ -67,78 +175,54 @@ def analyzer_scan(analyzer,
     '''
     import numpy as np
     import matplotlib.pyplot as plt
-    import os
     import time
-    from general_tools import save_array, save_scan
+    from sweep import Axis, Detector, Sweep, SaveScanSink, AsyncWriter
     
     parameters = [['Analyzer reference level (dBm)', str(float(ref_level))],
                   ['Analyzer span (MHz)', str(float(span))],
                   ['Analyzer bandwidth (MHz)', str(float(bandwidth))],
                   ['Pause before scan (s)', str(float(init_pause))],
                   ['Pause between traces (s)', str(float(pause))],
+                  ['Settle mode', settle],
                   ['Data points per trace', str(0)]
                  ]
     
-    #scan_array_0 will be x-values, i.e., frequencies.
-    #scan_array_1 will by y-values, i.e., power readings.
-    scan_array_0 = np.arange(float(freq_min), freq_max + freq_step, freq_step)
-    scan_array_1 = 0.0 * scan_array_0
+    #x-values, i.e., frequencies.
+    freqs = np.arange(float(freq_min), freq_max + freq_step, freq_step)
     
     analyzer.set_span(span)
     analyzer.set_bandwidth(bandwidth)
     analyzer.set_reference_level(ref_level)
+    if settle != 'pause':
+        analyzer.set_continuous(0)
     
     time.sleep(init_pause)
     
-    scan_ind = 0
     start_time = time.time() - init_pause
     
-    #Directory for saved traces
-    trace_dir = time.strftime('scans/%Y-%m-%d-%H-%M-%S_trace', time.localtime(start_time))
-    if save_trace:
-        try:
-            os.mkdir('scans')
-        except:
-            #print('could not make one of the directories')
-            pass
-        try:
-            os.mkdir(trace_dir)
-        except:
-            #print('could not make one of the directories')
-            pass
+    #traces are written from a background thread, and flushed to disk
+    #when the sweep closes its sinks
+    writer = AsyncWriter() if save_trace else None
+    
+    set_freq, read_power = _analyzer_reading(analyzer, parameters, start_time,
+                                             save_trace=save_trace, settle=settle,
+                                             sweep_timeout=sweep_timeout,
+                                             readout=readout, writer=writer)
+    sweep = Sweep([Axis('freq', freqs, set_freq,
+                        settle=pause if settle == 'pause' else 0.)],
+                  [Detector('power', read_power)],
+                  sinks=([writer] if writer is not None else [])
+                        + [SaveScanSink(parameters=parameters, scan_time=start_time)])
+    try:
+        result = sweep.run()
+    finally:
+        if settle != 'pause':
+            analyzer.set_continuous(1)
     
-    for freq in scan_array_0:
-        #print(str(freq) + ' MHz')
-        analyzer.set_frequency(freq)
-        time.sleep(pause)
-        
-        readings = analyzer.trace()
-        readings_ind = (np.where(readings[0] == freq))[0][0]
-        #print(readings[0, readings_ind])
-        #print(readings[1, readings_ind])
-        value = readings[1, readings_ind]
-        scan_array_1[scan_ind] = value
-        
-        #Save all traces
-        if save_trace:
-            save_array(trace_dir + '/' + str(freq) + '.txt', np.transpose(readings), delimiter=',')
-        
-        scan_ind = scan_ind + 1
-        #Find total scan time based on time taken for first scan.
-        if scan_ind == 1:
-            scan_time = time.time() - (start_time + init_pause)
-            end_time = start_time + init_pause + len(scan_array_0) * scan_time
-            print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
-            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
-            
-            #Data points per trace
-            parameters[-1][1] = str(len(readings[0]))
-        
-    scan_array = np.array([scan_array_0, scan_array_1])
-    save_scan(np.transpose(scan_array), scan_time=start_time, parameters=parameters)
+    scan_array = np.array([freqs, result.data['power']])
     
     if plot:
-        plt.plot(scan_array_0, scan_array_1)
+        plt.plot(scan_array[0], scan_array[1])
     
     return scan_array
 
@@ -154,9 +238,19 @@ def generator_analyzer_scan(generator, analyzer,
                 generator_power=-50.0, rf=1,
                 ref_level=-63.0, span=30, bandwidth=0.01,
                 init_pause = 5.0, pause=1.0,
-                plot=False, save_trace=False):
+                plot=False, save_trace=False,
+                settle='pause', sweep_timeout=None, readout=None,
+                generator_settle=0.0, concurrent=True):
     '''
     Requires classes hp_8647 and hp_e4401 from instruments.py.
+    
+    settle, readout: as in analyzer_scan.
+    
+    The generator and the analyzer are tuned at the same time, each
+    from its own thread (see sweep.Dispatcher): the generator then
+    waits generator_settle (s), the analyzer `pause` (settle='pause'),
+    and the trace is read once both are done. concurrent=False tunes
+    them one after the other.
     Example: initialize as and use as...
     
     >>>#Initialization...
@@ -183,97 +277,153 @@ def generator_analyzer_scan(generator, analyzer,
     '''
     import numpy as np
     import matplotlib.pyplot as plt
-    import os
     import time
-    from general_tools import save_array, save_scan
+    from sweep import (Axis, Detector, Sweep, SaveScanSink, AsyncWriter,
+                       Dispatcher, Target, locked)
     
     parameters = [['Generator power (dBm)', str(float(generator_power))],
                   ['Generator RF on', str(bool(rf))],
+                  ['Generator settle (s)', str(float(generator_settle))],
                   ['Analyzer reference level (dBm)', str(float(ref_level))],
                   ['Analyzer span (MHz)', str(float(span))],
                   ['Analyzer bandwidth (MHz)', str(float(bandwidth))],
                   ['Pause before scan (s)', str(float(init_pause))],
                   ['Pause between traces (s)', str(float(pause))],
+                  ['Settle mode', settle],
                   ['Data points per trace', str(0)]
                  ]
     
-    #scan_array_0 will be x-values, i.e., frequencies.
-    #scan_array_1 will by y-values, i.e., power readings.
-    scan_array_0 = np.arange(float(freq_min), freq_max + freq_step, freq_step)
-    scan_array_1 = 0.0 * scan_array_0
+    #x-values, i.e., frequencies.
+    freqs = np.arange(float(freq_min), freq_max + freq_step, freq_step)
     
     generator.set_power(generator_power)
     analyzer.set_span(span)
     analyzer.set_bandwidth(bandwidth)
     analyzer.set_reference_level(ref_level)
+    if settle != 'pause':
+        analyzer.set_continuous(0)
     
     generator.rf_on = rf
     time.sleep(init_pause)
     
-    scan_ind = 0
     start_time = time.time() - init_pause
     
-    #Directory for saved traces
-    trace_dir = time.strftime('scans/%Y-%m-%d-%H-%M-%S_trace', time.localtime(start_time))
-    if save_trace:
-        try:
-            os.mkdir('scans')
-        except:
-            #print('could not make one of the directories')
-            pass
-        try:
-            os.mkdir(trace_dir)
-        except:
-            #print('could not make one of the directories')
-            pass
+    writer = AsyncWriter() if save_trace else None
     
-    for freq in scan_array_0:
-        #print(str(freq) + ' MHz')
-        generator.set_frequency(freq)
-        analyzer.set_frequency(freq)
-        time.sleep(pause)
-        
-        readings = analyzer.trace()
-        readings_ind = (np.where(readings[0] == freq))[0][0]
-        #print(readings[0, readings_ind])
-        #print(readings[1, readings_ind])
-        value = readings[1, readings_ind]
-        scan_array_1[scan_ind] = value
-        
-        #Save all traces
-        if save_trace:
-            save_array(trace_dir + '/' + str(freq) + '.txt', np.transpose(readings), delimiter=',')
-        
-        scan_ind = scan_ind + 1
-        #Find total scan time based on time taken for first scan.
-        if scan_ind == 1:
-            scan_time = time.time() - (start_time + init_pause)
-            end_time = start_time + init_pause + len(scan_array_0) * scan_time
-            print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
-            print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
-            
-            #Data points per trace
-            parameters[-1][1] = str(len(readings[0]))
-    
-    generator.rf_on = 0
-    
-    scan_array = np.array([scan_array_0, scan_array_1])
-    save_scan(np.transpose(scan_array), scan_time=start_time, parameters=parameters)
+    set_analyzer, read_power = _analyzer_reading(analyzer, parameters, start_time,
+                                                 save_trace=save_trace, settle=settle,
+                                                 sweep_timeout=sweep_timeout,
+                                                 readout=readout, writer=writer)
+    
+    set_freq = Dispatcher([Target('generator', generator.set_frequency, generator,
+                                  settle=generator_settle),
+                           Target('analyzer', set_analyzer, analyzer,
+                                  settle=pause if settle == 'pause' else 0.)],
+                          concurrent=concurrent)
+    
+    sweep = Sweep([Axis('freq', freqs, set_freq)],
+                  [Detector('power', locked(analyzer, read_power))],
+                  sinks=([writer] if writer is not None else [])
+                        + [SaveScanSink(parameters=parameters, scan_time=start_time)])
+    try:
+        result = sweep.run()
+    finally:
+        set_freq.close()
+        generator.rf_on = 0
+        if settle != 'pause':
+            analyzer.set_continuous(1)
+    
+    scan_array = np.array([freqs, result.data['power']])
     
     if plot:
-        plt.plot(scan_array_0, scan_array_1)
+        plt.plot(scan_array[0], scan_array[1])
     
     return scan_array
 
+#Checkpoint file for a long scan: a new one named after the scan's
+#start time, or the one given by `resume`, which must have been taken
+#with the same parameters. The resumed scan keeps the checkpoint's
+#start time, so it is saved under the same file name, with all the
+#points. The instrument `state` saved with the checkpoint is compared
+#with the one the scan is about to set, with a warning for every
+#setting that differs. Returns (path, checkpoint or None, start_time).
+def _checkpoint(base_name, parameters, start_time, resume=None, state=None):
+    import time
+    import warnings
+    from sweep import load_checkpoint
+    
+    if resume is None:
+        time_str = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(start_time))
+        return 'scans/%s_%s_checkpoint.json' % (base_name, time_str), None, start_time
+    
+    checkpoint = load_checkpoint(resume)
+    if checkpoint['parameters'] != parameters:
+        raise ValueError('checkpoint %s was taken with different parameters' % resume)
+    if checkpoint['complete']:
+        print('Checkpoint %s is of a completed scan' % resume)
+    saved = checkpoint.get('state') or {}
+    for name in sorted(set(saved) | set(state or {})):
+        if saved.get(name) != (state or {}).get(name):
+            warnings.warn('%s was %s when checkpoint %s was taken, now %s'
+                          % (name, saved.get(name), resume, (state or {}).get(name)))
+    return resume, checkpoint, checkpoint['start_time']
+
+#Next frequencies for an adaptive scan, from the points so far: the
+#midpoints of the intervals next to points that stand out from the
+#baseline (median) or from their neighbours (second difference), by
+#more than `threshold` times the noise (from the median absolute
+#deviation). Intervals narrower than 2 * min_step are not split. At
+#most `n` midpoints, the highest scoring ones first.
+def _refine_freqs(freqs, counts, n, min_step, threshold=3.0):
+    import numpy as np
+    
+    order = np.argsort(freqs)
+    x = np.asarray(freqs, dtype=float)[order]
+    y = np.asarray(counts, dtype=float)[order]
+    if len(x) < 2 or n < 1:
+        return np.zeros(0)
+    
+    baseline = np.median(y)
+    noise = 1.4826 * np.median(np.abs(y - baseline))
+    if not noise > 0:
+        noise = np.std(y) if np.std(y) > 0 else 1.0
+    
+    score = np.abs(y - baseline) / noise
+    #the second difference of pure noise has sqrt(6) times its spread
+    curvature = np.abs(y[:-2] - 2 * y[1:-1] + y[2:]) / (np.sqrt(6) * noise)
+    score[1:-1] = np.maximum(score[1:-1], curvature)
+    
+    interval_score = np.maximum(score[:-1], score[1:])
+    interval_score[np.diff(x) < 2 * min_step * (1 - 1e-9)] = 0
+    split = np.argsort(interval_score)[::-1][:n]
+    split = split[interval_score[split] > threshold]
+    return np.sort((x[split] + x[split + 1]) / 2.0)
+
 def cw_odmr_scan(generator,
               power_dBm, freq_center, freq_span, freq_step,
               amplifier_dBm=30.0, lag=0.1,
               count_time=0.1, repeat_each_freq=1,
-              init_pause=0.0, overlay=False):
+              init_pause=0.0, overlay=False,
+              checkpoint_every=10, resume=None,
+              adaptive=False, coarse=4, max_points=None, threshold=3.0):
     '''
     Requires class hp_8647 or similar from instruments.py.
     Example: initialize as and use as...
     
+    Adaptive mode (adaptive=True): first a coarse pass, every `coarse`-th
+    frequency of the grid, then passes that add the midpoints of the
+    intervals where the counts stand out from the baseline or curve (by
+    more than `threshold` times the noise), down to freq_step, until no
+    interval needs refining or max_points points (default: half the grid)
+    have been measured. The points are saved in frequency order at the
+    end. Not checkpointed.
+    
+    Checkpoints: every checkpoint_every points, the scan so far is saved to
+    scans/cw_odmr_<start time>_checkpoint.json. If the scan is interrupted,
+    run it again with the same arguments and resume=<that file>: the
+    generator is set up again, and the scan continues from the first
+    missing frequency. The checkpoint is deleted once the scan completes.
+    
     Averaging parameter: effective averging parameter is count_time * repeat_each_freq.
     - count_time: how long, in s, to leave take in APD counts. APD samples at 10 Hz, so
     e.g., count_time=1 would have 1 s and 10 samples per data point.
@@ -306,11 +456,8 @@ def cw_odmr_scan(generator,
     >>>cw_odmr_scan(hp, power_dBm, freq_center, freq_span, freq_step, count_time=count_time)
     '''
     import numpy as np
-    import matplotlib.pyplot as plt
     import time
-    from itertools import count
-    from wanglib.util import scanner, averager
-    from wanglib.pylab_extensions.live_plot import plotgen
+    from sweep import Axis, Detector, Sweep, PlotSink, SaveScanSink, CheckpointSink
     from general_tools import save_scan
     from expt_supp import doct
     
@@ -345,42 +492,75 @@ def cw_odmr_scan(generator,
     #freqs = np.repeat(freqs, repeat_each_freq)
     
     start_time = time.time() - init_pause
-    end_time = start_time + init_pause + (count_time + lag) * len(freqs) * repeat_each_freq
-    
-    print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
-    print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
-    #print(freqs)
-    
-    if repeat_each_freq < 2:
-        odmr = scanner(freqs, set=generator.set_frequency, get=doct2, lag=lag)
-    
-    else:
-        acq = averager(doct2, repeat_each_freq, lag=lag)
-        odmr = scanner(freqs, set=generator.set_frequency, get=acq)
-    
-    #remove previous scans from plot that will be displayed
-    if not overlay:
-        plt.clf()
-    
-    data = plotgen(odmr)
-    generator.set_rf(0)
-    
-    #Save scan data
-    save_scan(np.transpose(data), base_name='cw_odmr', scan_time=start_time, parameters=parameters)
+    #start and estimated end times are printed by the sweep
+    
+    if adaptive:
+        if resume is not None:
+            raise ValueError('resume is not supported with adaptive')
+        if max_points is None:
+            max_points = len(freqs) // 2
+        parameters = parameters + [['Adaptive coarse factor', str(int(coarse))],
+                                   ['Adaptive maximum points', str(int(max_points))],
+                                   ['Adaptive threshold', str(float(threshold))]]
+        
+        scan_freqs, scan_counts = [], []
+        scan_array = None
+        new_freqs = freqs[::int(coarse)]
+        try:
+            while len(new_freqs):
+                #the coarse pass as a line, refinements as points over it
+                first = not scan_freqs
+                sweep = Sweep([Axis('freq', new_freqs, generator.set_frequency, settle=lag)],
+                              [Detector('counts', doct2, repeat=repeat_each_freq, lag=lag)],
+                              sinks=[PlotSink(overlay=overlay or not first,
+                                              fmt='.-' if first else 'o')],
+                              report=first)
+                result = sweep.run()
+                scan_freqs.extend(new_freqs)
+                scan_counts.extend(result.data['counts'])
+                new_freqs = _refine_freqs(scan_freqs, scan_counts,
+                                          max_points - len(scan_freqs), freq_step,
+                                          threshold=threshold)
+        finally:
+            generator.set_rf(0)
+            if scan_freqs:
+                order = np.argsort(scan_freqs)
+                scan_array = np.array([scan_freqs, scan_counts])[:, order]
+                save_scan(np.transpose(scan_array), base_name='cw_odmr',
+                          parameters=parameters + [['Points measured', str(len(scan_freqs))]],
+                          scan_time=start_time)
+        return scan_array
+    
+    state = {'Generator power (dBm)': power_dBm - amplifier_dBm, 'RF on': 1}
+    checkpoint_path, checkpoint, start_time = _checkpoint('cw_odmr', parameters,
+                                                          start_time, resume, state)
+    
+    #overlay=False removes previous scans from the plot
+    sweep = Sweep([Axis('freq', freqs, generator.set_frequency, settle=lag)],
+                  [Detector('counts', doct2, repeat=repeat_each_freq, lag=lag)],
+                  sinks=[PlotSink(overlay=overlay),
+                         SaveScanSink(base_name='cw_odmr', parameters=parameters,
+                                      scan_time=start_time),
+                         CheckpointSink(checkpoint_path, every=checkpoint_every,
+                                        parameters=parameters, state=state)],
+                  resume=checkpoint)
+    try:
+        sweep.run()
+    finally:
+        generator.set_rf(0)
 
 #Scan that jumps between two frequencies until told to
 #stop. Purpose is to be able to actively focus so as to
 #maximize the difference in signal between the two points.
+#Plotted live from a separate process, so that drawing does
+#not slow down the point rate.
 def focus_scan(generator,
               power_dBm, freq_1, freq_2, scan_time,
               amplifier_dBm=30.0, lag=0.1, count_time=0.1,
               init_pause=0.0):
     import numpy as np
-    import matplotlib.pyplot as plt
     import time
-    from itertools import count
-    from wanglib.util import scanner
-    from wanglib.pylab_extensions.live_plot import plotgen
+    from sweep import Axis, Detector, Sweep, LivePlotSink
     from expt_supp import doct
     
     def doct2(t=count_time):
@@ -397,10 +577,13 @@ def focus_scan(generator,
     
     time.sleep(init_pause)
     
-    focus_scanner = scanner(freqs, set=generator.set_frequency, get=doct2, lag=lag)
-    
-    data = plotgen(focus_scanner)
-    generator.rf_on = 0
+    sweep = Sweep([Axis('freq', freqs, generator.set_frequency, settle=lag)],
+                  [Detector('counts', doct2)],
+                  sinks=[LivePlotSink(x='freq', fmt='.')], report=False)
+    try:
+        sweep.run()
+    finally:
+        generator.rf_on = 0
 
 #Does a Rabi oscillation scan. Based on Ignas's iPython notebook from Fluorescence Microscopy Setup 1.
 def rabi_osc_scan(generator, power_dBm, freq,
@@ -408,18 +591,27 @@ def rabi_osc_scan(generator, power_dBm, freq,
               amplifier_dBm=30.0, init_pause=0.0,
               loop_num=500000, repeat_each_pulse_width=1,
               green_time=2300, det_time=300, off_time=650,
-              overlay=False):
+              overlay=False, batched=False,
+              checkpoint_every=10, resume=None):
     '''
     Requires class hp_8647 or similar from instruments.py.
     
+    - checkpoint_every, resume: as in cw_odmr_scan; the checkpoints are
+    scans/rabi_osc_<start time>_checkpoint.json, and a resumed scan continues
+    from the first missing pulse width.
+    - batched: run all pulse widths in one spincore program, binning the
+    counts per width with the marker channel (see expt_supp.gen_scan_batched).
+    Needs the marker channel wired to the DAQ card.
+    
     Averaging parameter: effective averging parameter is loop_num * repeat_each_pulse_width.
     - loop_num: number of times that Rabi pulse sequence (basically, mw + detection)
     is performed. Each measurement includes the sum of all of what is detected
     from all of these pulse sequences, so loop_num is number of photon detections
     that are averaged for a given mw pulse time.
-    - repeat_each_pulse_width: can measure at each mw pulse time more than once - this is
-    mainly to get around the issue that loop_num has an upper limit (2**20 on one day
-    that I tested it) before memory issues occur.
+    - repeat_each_pulse_width: can measure at each mw pulse time more than once. This
+    used to get around the upper limit of loop_num (2**20, the largest loop count the
+    spincore card takes); larger loop_num now runs on the card as nested loops, and the
+    counts are accumulated to 64 bits, so it is only needed to interleave repeats.
     - Note: for each iteration of loop_num, count_time = det_time * spin.ns * pulses in
     expt_supp.py, so hard to state exact count time. But, to control it, adjust det_time.
     
@@ -450,12 +642,9 @@ def rabi_osc_scan(generator, power_dBm, freq,
     >>>rabi_osc_scan(hp, power_dBm, freq, mw_pulse_min, mw_pulse_max, mw_pulse_step)
     '''
     import numpy as np
-    import matplotlib.pyplot as plt
     import time
-    from wanglib.pylab_extensions.live_plot import plotgen
-    from wanglib.util import scanner
-    from general_tools import save_scan
-    from expt_supp import gen_scan
+    from sweep import stream, PlotSink, SaveScanSink, CheckpointSink
+    from expt_supp import gen_scan, gen_scan_batched
     
     parameters = [['Intended input power (dBm)', str(float(power_dBm))],
                   ['Generator power (dBm)', str(float(power_dBm - amplifier_dBm))],
@@ -469,6 +658,7 @@ def rabi_osc_scan(generator, power_dBm, freq,
                   ['green_time', str(green_time)],
                   ['det_time', str(float(det_time))],
                   ['off_time', str(float(off_time))],
+                  ['batched', str(bool(batched))],
                   ]
     
     generator.set_power(power_dBm - amplifier_dBm)
@@ -485,23 +675,118 @@ def rabi_osc_scan(generator, power_dBm, freq,
     if widths[-1] > mw_pulse_max:
         widths = widths[: -1]
     
-    if repeat_each_pulse_width >= 2:
+    if repeat_each_pulse_width >= 2 and not batched:
         widths = np.repeat(widths, repeat_each_pulse_width)
     
     start_time = time.time() - init_pause
+    state = {'Generator power (dBm)': power_dBm - amplifier_dBm,
+             'Generator frequency (MHz)': freq, 'RF on': 1, 'Pulsed': 1}
+    checkpoint_path, checkpoint, start_time = _checkpoint('rabi_osc', parameters,
+                                                          start_time, resume, state)
     print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
     #estimated end time calculated and printed by gen_scan function below
     
-    gen = gen_scan(widths, loop_num=loop_num, repeat_each_pulse_width=repeat_each_pulse_width, det_time=det_time, off_time=off_time)
-    data = plotgen(gen)
-    if not overlay:
-        plt.clf()
+    if checkpoint is not None:
+        #gen_scan yields one point per repeat_each_pulse_width widths,
+        #gen_scan_batched one per width (batched is in the parameters,
+        #so it is the same as in the checkpoint)
+        done = len(checkpoint['points'])
+        widths = widths[done * (1 if batched else repeat_each_pulse_width):]
+        print('Resuming after %d points' % done)
     
-    generator.set_rf(0)
-    generator.set_pulsed(0)
+    if batched:
+        gen = gen_scan_batched(widths, loop_num=loop_num, repeat_each_pulse_width=repeat_each_pulse_width, det_time=det_time, off_time=off_time)
+    else:
+        gen = gen_scan(widths, loop_num=loop_num, repeat_each_pulse_width=repeat_each_pulse_width, det_time=det_time, off_time=off_time)
     
-    #Save scan data
-    save_scan(np.transpose(data), base_name='rabi_osc', scan_time=start_time, parameters=parameters)
+    #gen_scan sets and reads the hardware itself; the sweep engine
+    #plots and saves its points
+    try:
+        stream(gen, ['width', 'counts'],
+               sinks=[PlotSink(overlay=overlay),
+                      SaveScanSink(base_name='rabi_osc', parameters=parameters,
+                                   scan_time=start_time),
+                      CheckpointSink(checkpoint_path, every=checkpoint_every,
+                                     parameters=parameters, state=state)],
+               resume=checkpoint)
+    finally:
+        generator.set_rf(0)
+        generator.set_pulsed(0)
+
+#Ramsey, T1 or Hahn-echo scan: the whole sweep of delays in batched
+#spincore programs, with normalization references.
+def pulsed_scan(generator, power_dBm, freq, family, delays, pi_time=None,
+                amplifier_dBm=30.0, init_pause=0.0,
+                loop_num=500000, repeat=1, references=True,
+                green_time=2300, det_time=300, off_time=650,
+                batch=20, overlay=False):
+    '''
+    Requires class hp_8647 or similar from instruments.py.
+    
+    - family: 'ramsey' (free precession delay between pi/2 pulses), 't1'
+    (relaxation delay, after a pi pulse if pi_time is given), 'echo' (delay on
+    each side of the pi pulse of a Hahn echo) or 'rabi' (mw pulse width).
+    See pulse_seq.sweep_sequence.
+    - delays: the delays (ns) to sweep, in any order.
+    - pi_time: mw pi pulse length (ns), e.g. from rabi_osc_scan. Needed for
+    ramsey, echo and the references.
+    - references: measure bright (no mw) and dark (pi pulse) references with
+    every delay, and plot the normalized signal: 1 for m=0, 0 for m=1.
+    - loop_num, repeat: averaging, as loop_num and repeat_each_pulse_width in
+    rabi_osc_scan.
+    - batch: delays per spincore program; the plot updates after each batch.
+    
+    Example, a T1 curve with 100 delays up to 1 ms:
+    
+    >>>pulsed_scan(hp, 30.0, 2871.0, 't1', np.linspace(0, 1e6, 100),
+    ...            pi_time=60.0, loop_num=2000)
+    '''
+    import numpy as np
+    import time
+    from sweep import stream, PlotSink, SaveScanSink
+    from expt_supp import gen_sweep_batched
+    
+    parameters = [['Intended input power (dBm)', str(float(power_dBm))],
+                  ['Generator power (dBm)', str(float(power_dBm - amplifier_dBm))],
+                  ['Assumed amplifier gain (dBm)', str(float(amplifier_dBm))],
+                  ['Generator frequency (MHz)', str(float(freq))],
+                  ['Sequence family', family],
+                  ['Minimum delay (ns)', str(float(np.min(delays)))],
+                  ['Maximum delay (ns)', str(float(np.max(delays)))],
+                  ['Number of delays', str(len(delays))],
+                  ['pi_time', str(pi_time)],
+                  ['references', str(bool(references))],
+                  ['loop_num', str(int(loop_num))],
+                  ['repeat', str(int(repeat))],
+                  ['green_time', str(green_time)],
+                  ['det_time', str(float(det_time))],
+                  ['off_time', str(float(off_time))],
+                  ]
+    
+    generator.set_power(power_dBm - amplifier_dBm)
+    generator.set_frequency(freq)
+    
+    generator.set_rf(1)
+    generator.set_pulsed(1) #Works on machines with hardware for pulsed mode only
+    
+    time.sleep(init_pause)
+    
+    start_time = time.time() - init_pause
+    print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
+    #estimated end time calculated and printed by gen_sweep_batched below
+    
+    gen = gen_sweep_batched(family, delays, pi_time=pi_time, loop_num=loop_num,
+                            references=references, repeat=repeat,
+                            green_time=green_time, det_time=det_time,
+                            off_time=off_time, batch=batch)
+    try:
+        stream(gen, ['delay', 'signal'],
+               sinks=[PlotSink(overlay=overlay),
+                      SaveScanSink(base_name=family, parameters=parameters,
+                                   scan_time=start_time)])
+    finally:
+        generator.set_rf(0)
+        generator.set_pulsed(0)
 
 #Does a Rabi oscillation scan. Based on Mayra's iPython notebook from Croystat Setup 2.
 def rabi_scan(generator, power_dBm, freq, 
@@ -541,13 +826,11 @@ def rabi_scan(generator, power_dBm, freq,
     >>>rabi_scan(gen, power_dBm, freq, mw_pulse_min, mw_pulse_max, mw_pulse_step)
     '''
     import numpy as np
-    import matplotlib.pyplot as plt
     import time
     from functools import partial
-    from wanglib.pylab_extensions.live_plot import plotgen
-    from wanglib.util import scanner
-    from general_tools import save_scan
-    from rabi_supp import rabi_start, do_count_v2, initialize, stop, close
+    from sweep import Axis, Detector, Sweep, PlotSink, SaveScanSink
+    from rabi_supp import (rabi_start, do_count_v2, get_gated_counter,
+                           release_gated_counter, initialize, stop)
     
     parameters = [['Intended input power (dBm)', str(float(power_dBm))],
                   ['Generator power (dBm)', str(float(power_dBm - amplifier_dBm))],
@@ -577,29 +860,37 @@ def rabi_scan(generator, power_dBm, freq,
     
     initialize()
     
-    time.sleep(init_pause)
-    start_time = time.time() - init_pause
-    end_time = start_time + init_pause + (count_time + lag) * len(widths)
-    
-    print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
-    print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
-    
-    #Note: count_time is time spent on each frequency, not total time that APD is counting.
-    #Note: count_time only works up to whatever time loop_num allows.
-    sgen = scanner(widths,
-                   get=partial(do_count_v2, count_time),
-                   set=rabi_pulse,
-                   lag=lag)
-    
-    if not overlay:
-        plt.clf()
-    
-    data = plotgen(sgen)
-    
-    save_scan(np.transpose(data), base_name='cw_odmr', scan_time=start_time, parameters=parameters)
-    
+    #counters are configured once here, and re-armed for every width
+    counter = get_gated_counter(count_time)
+    counter.reset_timing()
+    try:
+        time.sleep(init_pause)
+        start_time = time.time() - init_pause
+        end_time = start_time + init_pause + (count_time + lag) * len(widths)
+        
+        print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
+        print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+        
+        #Note: count_time is time spent on each frequency, not total time that APD is counting.
+        #Note: count_time only works up to whatever time loop_num allows.
+        sweep = Sweep([Axis('width', widths, rabi_pulse, settle=lag)],
+                      [Detector('counts', partial(do_count_v2, count_time))],
+                      sinks=[PlotSink(overlay=overlay),
+                             SaveScanSink(base_name='cw_odmr', parameters=parameters,
+                                          scan_time=start_time)],
+                      report=False)
+        sweep.run()
+        
+        timing = counter.timing()
+        if timing:
+            print('Counting overhead per point: %.1f ms' % (timing['overhead'] * 1000.0))
+    finally:
+        #the committed counters stay reserved until released
+        release_gated_counter()
+    
+    #leave the board initialized for the next scan; close_session()
+    #in session.py releases it.
     stop()
-    close()
     
     generator.set_rf(0)
     generator.set_pulsed(0)
\ No newline at end of file
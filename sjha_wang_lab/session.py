@@ -0,0 +1,105 @@
+'''
+session.py
+Explicit hardware session for the SpinCore PulseBlaster, and for the
+DAQ tasks that go with it. Nothing touches the hardware on import:
+the board is initialized when a session is opened, once per
+experiment, and every scan shares it.
+
+Example:
+
+>>>from session import get_session, close_session
+>>>
+>>>session = get_session()   # initializes the board the first time
+>>>...                       # run any number of scans
+>>>close_session()
+'''
+
+class HardwareSession(object):
+    """
+    Owns the PulseBlaster initialization (pb_init, core clock) and any
+    DAQ tasks or other resources registered with resource(), and
+    releases them together on close(). Can be used as a context
+    manager.
+    """
+    def __init__(self, clock=500):
+        self.clock = clock     # core clock, MHz
+        self.is_open = False
+        self.resources = {}
+        # instructions currently on the board, if known
+        self.loaded_program = None
+
+    def open(self):
+        """ initialize the board, unless this session already did """
+        if self.is_open:
+            return self
+        import spinapi as spin
+
+        if spin.pb_init() != 0:
+            raise RuntimeError('Error initializing board: %s' % spin.pb_get_error())
+
+        if spin.pb_count_boards() == 1: # check to see if we have one spincore card
+            spin.pb_core_clock(self.clock)
+        else:
+            print('SpinCore board not found')
+
+        self.is_open = True
+        self.loaded_program = None
+        return self
+
+    def resource(self, key, factory):
+        """
+        Return the resource stored under `key`, making it with
+        `factory()` the first time. Use it for DAQ tasks that should
+        be configured once and reused by every scan.
+        """
+        if key not in self.resources:
+            self.resources[key] = factory()
+        return self.resources[key]
+
+    def release(self, key):
+        """ close the resource stored under `key` now, if there is one """
+        resource = self.resources.pop(key, None)
+        if resource is not None:
+            _close(resource)
+
+    def close(self):
+        """ release the resources and the board """
+        for resource in self.resources.values():
+            _close(resource)
+        self.resources = {}
+
+        if self.is_open:
+            import spinapi as spin
+            spin.pb_stop()
+            spin.pb_close()
+        self.is_open = False
+        self.loaded_program = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _close(resource):
+    for method in ('close', 'ClearTask'):
+        if hasattr(resource, method):
+            getattr(resource, method)()
+            break
+
+# Process-wide session, shared by everything that calls get_session()
+_session = None
+
+def get_session(clock=500):
+    """ the process-wide HardwareSession, opened on first use """
+    global _session
+    if _session is None:
+        _session = HardwareSession(clock=clock)
+    return _session.open()
+
+def close_session():
+    """ close the process-wide session, if there is one """
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
@@ -0,0 +1,929 @@
+'''
+sweep.py
+Sweep engine for the scans in scans.py: set the axes, wait for them
+to settle, read the detectors, and hand every point to a list of
+sinks (save to a file, live plot, callback), over any number of axes.
+
+Readout and the sinks are pipelined: the points are measured on a
+worker thread, which sets the next setpoint as soon as the current
+readout is done, while the calling thread runs the sinks (plotting
+and saving) for the point before. LivePlotSink plots from a separate
+process, so that drawing never holds up the readout. A Dispatcher sets several
+instruments for one axis concurrently, each on its own thread.
+
+Example, a 2-D scan of generator frequency and power:
+
+>>>from sweep import Axis, Detector, Sweep, PlotSink, SaveScanSink
+>>>
+>>>sweep = Sweep([Axis('power', [-10, -5, 0], hp.set_power, settle=.5),
+...               Axis('freq', freqs, hp.set_frequency, settle=.1)],
+...              [Detector('counts', doct)],
+...              sinks=[PlotSink(), SaveScanSink('odmr_power')])
+>>>result = sweep.run()
+>>>result.data['counts'].shape
+(3, 50)
+'''
+import os
+import time
+import threading
+import itertools
+from collections import namedtuple
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# ----
+# AXES
+# ----
+
+class Axis(object):
+    """
+    A swept quantity: `set` is called with each of `values`, then the
+    sweep waits `settle` seconds before reading the detectors.
+    """
+    def __init__(self, name, values, set, settle=0.):
+        self.name = name
+        self.values = np.asarray(values)
+        self.set = set
+        self.settle = settle
+
+    def __len__(self):
+        return len(self.values)
+
+class Detector(object):
+    """
+    A measured quantity: `get()` returns its value. With `repeat` > 1
+    the value is the mean of `repeat` readings, `lag` seconds apart
+    (like wanglib.util.averager).
+    """
+    def __init__(self, name, get, repeat=1, lag=0.):
+        self.name = name
+        self.get = get
+        self.repeat = int(repeat)
+        self.lag = lag
+
+    def read(self):
+        if self.repeat < 2:
+            return self.get()
+        total = 0.
+        for i in range(self.repeat):
+            if i:
+                time.sleep(self.lag)
+            total = total + self.get()
+        return total / float(self.repeat)
+
+# One measured point: its index in the grid, the axis values, the
+# detector values (in the order of the sweep's axes and detectors),
+# and when it was read (s since the start of the sweep).
+Point = namedtuple('Point', 'index setpoint values time')
+
+SweepResult = namedtuple('SweepResult', 'axes data start_time')
+
+# -----------
+# INSTRUMENTS
+# -----------
+
+# One lock per VISA resource, shared by everything that talks to it
+_resource_locks = {}
+_resource_locks_lock = threading.Lock()
+
+def resource_lock(instrument):
+    """
+    The lock for `instrument`'s VISA resource (its .inst, as the
+    classes in instruments.py keep it, or the resource itself). Hold
+    it around every exchange with the instrument from a thread.
+    """
+    resource = getattr(instrument, 'inst', instrument)
+    with _resource_locks_lock:
+        if id(resource) not in _resource_locks:
+            _resource_locks[id(resource)] = threading.RLock()
+        return _resource_locks[id(resource)]
+
+def locked(instrument, func):
+    """ func, called with `instrument`'s resource lock held """
+    lock = resource_lock(instrument)
+
+    def call(*args, **kwargs):
+        with lock:
+            return func(*args, **kwargs)
+    return call
+
+class Target(object):
+    """
+    One instrument to set at every setpoint of a Dispatcher: `set` is
+    called with the value (holding the instrument's resource lock),
+    then the instrument needs `settle` seconds before it can be read.
+    """
+    def __init__(self, name, set, instrument=None, settle=0.):
+        self.name = name
+        self.set = set
+        self.instrument = instrument
+        self.settle = settle
+
+class _Worker(object):
+    """ a thread that runs one Target's calls, in order """
+    def __init__(self, target):
+        self.target = target
+        self.lock = (resource_lock(target.instrument)
+                     if target.instrument is not None else threading.RLock())
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            value, done, errors = job
+            try:
+                with self.lock:
+                    self.target.set(value)
+                time.sleep(self.target.settle)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+    def submit(self, value):
+        done = threading.Event()
+        errors = []
+        self.jobs.put((value, done, errors))
+        return done, errors
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+class Dispatcher(object):
+    """
+    Sets several independent instruments to the same setpoint at
+    once, one worker thread per Target, and returns when all of them
+    are set and settled. The time per point is then the slowest
+    instrument's set and settle time, instead of the sum over all of
+    them. Use it as the `set` of an Axis (with settle 0), and close()
+    it at the end.
+
+    With concurrent=False the targets are set one after the other on
+    the calling thread (and each settle is waited for in turn).
+    """
+    def __init__(self, targets, concurrent=True):
+        self.targets = list(targets)
+        self.concurrent = concurrent
+        self.workers = [_Worker(t) for t in self.targets] if concurrent else []
+
+    def __call__(self, value):
+        if not self.concurrent:
+            for target in self.targets:
+                lock = (resource_lock(target.instrument)
+                        if target.instrument is not None else threading.RLock())
+                with lock:
+                    target.set(value)
+                time.sleep(target.settle)
+            return
+        jobs = [worker.submit(value) for worker in self.workers]
+        for done, errors in jobs:
+            done.wait()
+        for done, errors in jobs:
+            if errors:
+                raise errors[0]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# -----
+# SINKS
+# -----
+
+class Sink(object):
+    """
+    Receives the points of a sweep: start(sweep) before the first,
+    add(point) for each, close() at the end (also when the sweep is
+    interrupted).
+    """
+    def start(self, sweep):
+        self.sweep = sweep
+
+    def add(self, point):
+        pass
+
+    def close(self):
+        pass
+
+class CallbackSink(Sink):
+    """ calls `func(point)` for every point """
+    def __init__(self, func):
+        self.func = func
+
+    def add(self, point):
+        self.func(point)
+
+class FileSink(Sink):
+    """
+    Writes every point to the text file `path` as it comes in, one
+    row of comma-separated axis and detector values, after a header
+    line of names. Scalar detectors only.
+    """
+    def __init__(self, path, fmt='%.10g'):
+        self.path = path
+        self.fmt = fmt
+        self.f = None
+
+    def start(self, sweep):
+        Sink.start(self, sweep)
+        self.f = open(self.path, 'w')
+        self.f.write('# ' + ','.join(sweep.names) + '\n')
+
+    def add(self, point):
+        row = tuple(point.setpoint) + tuple(point.values)
+        self.f.write(','.join(self.fmt % v for v in row) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+class AsyncWriter(Sink):
+    """
+    Writes array files (e.g. one trace per point) from a background
+    thread, so that formatting and disk I/O stay out of the readout.
+    write_array() queues a file and returns at once; when more than
+    `depth` files are waiting it blocks until the writer catches up.
+
+    As a sink, it is flushed when the sweep ends: close() returns once
+    every queued file is written and synced to disk. An error on the
+    writer thread is raised by the next write_array() or close().
+    """
+    def __init__(self, depth=64):
+        self.depth = depth
+        self.jobs = None
+        self.thread = None
+        self.errors = []
+
+    def start(self, sweep=None):
+        if sweep is not None:
+            Sink.start(self, sweep)
+        if self.thread is None:
+            self.jobs = queue.Queue(self.depth)
+            self.errors = []
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                if not self.errors:
+                    self._write(*job)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.jobs.task_done()
+
+    @staticmethod
+    def _write(path, data, delimiter, newline):
+        from general_tools import save_array
+        save_array(path, data, delimiter=delimiter, newline=newline)
+        with open(path, 'a') as f:
+            os.fsync(f.fileno())
+
+    def _raise(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def write_array(self, path, data, delimiter=' ', newline='\n'):
+        """ queue `data` (1-D or 2-D) to be written to `path` """
+        self._raise()
+        if np.ndim(data) not in (1, 2):
+            raise ValueError('can only write 1-D or 2-D arrays')
+        self.start()
+        self.jobs.put((path, np.array(data), delimiter, newline))
+
+    def flush(self):
+        """ wait until every queued file is on disk """
+        if self.thread is not None:
+            self.jobs.join()
+        self._raise()
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.join()
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise()
+
+class SaveScanSink(Sink):
+    """
+    Saves the whole scan with general_tools.save_scan when the sweep
+    ends, as the scans in scans.py always have: one row per point,
+    axis values then detector values (any number of columns).
+
+    save_scan only prints a message when it cannot save; this raises
+    IOError instead, so that a scan is never lost quietly.
+    """
+    def __init__(self, base_name=None, parameters=None, **kwargs):
+        self.base_name = base_name
+        self.parameters = parameters
+        self.kwargs = kwargs
+        self.rows = []
+
+    def start(self, sweep):
+        Sink.start(self, sweep)
+        self.rows = []
+
+    def add(self, point):
+        self.rows.append(tuple(point.setpoint) + tuple(point.values))
+
+    def close(self):
+        from general_tools import save_scan
+        if not self.rows:
+            return
+        kwargs = dict(self.kwargs)
+        kwargs.setdefault('scan_time', self.sweep.start_time)
+        # save_scan wants exactly a float
+        kwargs['scan_time'] = float(kwargs['scan_time'])
+        if self.base_name is not None:
+            kwargs['base_name'] = self.base_name
+        if self.parameters is not None:
+            kwargs['parameters'] = self.parameters
+        data = np.array(self.rows, dtype=float)
+        # save_scan's default checks allow only [n, 2]
+        kwargs.setdefault('data_2d', data.shape[1] == 2)
+
+        # the file save_scan writes to (see general_tools.save_scan)
+        time_str = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(kwargs['scan_time']))
+        path = 'scans/%s_%s.%s' % (kwargs.get('base_name', 'scan'), time_str,
+                                   kwargs.get('ext', 'txt'))
+        before = time.time()
+        save_scan(data, **kwargs)
+        if not os.path.exists(path) or os.path.getmtime(path) < before - 2.:
+            raise IOError('scan was not saved to %s (see the message above)' % path)
+
+class PlotSink(Sink):
+    """
+    Live plot of detector `y` (name or index, default the first)
+    against axis `x` (default the innermost). On an N-D grid a new
+    line starts whenever the outer axes move. Redraws every `every`
+    points.
+    """
+    def __init__(self, x=-1, y=0, every=1, fmt='.-', overlay=True):
+        self.x = x
+        self.y = y
+        self.every = every
+        self.fmt = fmt
+        self.overlay = overlay
+
+    def start(self, sweep):
+        import matplotlib.pyplot as plt
+        Sink.start(self, sweep)
+        self.plt = plt
+        self.xi = self.x if isinstance(self.x, int) else sweep.axis_names.index(self.x)
+        self.xi %= len(sweep.axes)
+        self.yi = self.y if isinstance(self.y, int) else sweep.detector_names.index(self.y)
+        if not self.overlay:
+            plt.clf()
+        self.line = None
+        self.outer = None
+        self.n = 0
+
+    def add(self, point):
+        outer = point.index[:self.xi] + point.index[self.xi + 1:]
+        if self.line is None or outer != self.outer:
+            self.xs, self.ys = [], []
+            self.line, = self.plt.plot([], [], self.fmt)
+            self.outer = outer
+        self.xs.append(point.setpoint[self.xi])
+        self.ys.append(point.values[self.yi])
+        self.line.set_data(self.xs, self.ys)
+        self.n += 1
+        if self.n % self.every == 0:
+            self.draw()
+
+    def draw(self):
+        ax = self.line.axes
+        ax.relim()
+        ax.autoscale_view()
+        self.plt.pause(1e-3)
+
+    def close(self):
+        if self.line is not None:
+            self.draw()
+
+def decimate(x, y, n):
+    """
+    At most about 2 * `n` points of the line (x, y) that still show
+    its full range: the points are split in n runs, in order, and each
+    run is replaced by its minimum and maximum (in order).
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(y) <= 2 * n:
+        return x, y
+    edges = np.linspace(0, len(y), n + 1).astype(int)
+    keep = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        run = y[start:end]
+        lo, hi = start + np.argmin(run), start + np.argmax(run)
+        keep.extend(sorted(set((lo, hi))))
+    return x[keep], y[keep]
+
+def _live_plot(xs, ys, count, done, errors, x_label, y_label, fmt, fps):
+    """
+    The process behind LivePlotSink: redraws the line in the shared
+    arrays `xs`, `ys` (`count` points so far) `fps` times a second,
+    blitting just the line unless the axes limits have to grow. Ends
+    early if the window is closed. An error goes back to the sink by
+    the `errors` queue.
+    """
+    try:
+        _live_plot_loop(xs, ys, count, done, x_label, y_label, fmt, fps)
+    except Exception:
+        import traceback
+        errors.put(traceback.format_exc())
+        raise
+
+def _live_plot_loop(xs, ys, count, done, x_label, y_label, fmt, fps):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.set_xlabel(x_label)
+    ax.set_ylabel(y_label)
+    line, = ax.plot([], [], fmt, animated=True)
+    plt.show(block=False)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(ax.bbox)
+    limits = None
+    shown = 0
+
+    while True:
+        if not plt.fignum_exists(fig.number):
+            return
+        finished = done.is_set()
+        n = count.value
+        if n != shown and n > 0:
+            x = np.frombuffer(xs.get_obj())[:n]
+            y = np.frombuffer(ys.get_obj())[:n]
+            width = int(ax.bbox.width) or 500
+            line.set_data(*decimate(x, y, width))
+            lo = np.array([x.min(), y.min()])
+            hi = np.array([x.max(), y.max()])
+            if limits is None or (lo < limits[0]).any() or (hi > limits[1]).any():
+                #grow the limits with a margin, and redraw everything once
+                pad = 0.05 * np.where(hi > lo, hi - lo, np.abs(hi) + 1.0)
+                limits = (lo - pad, hi + pad)
+                ax.set_xlim(limits[0][0], limits[1][0])
+                ax.set_ylim(limits[0][1], limits[1][1])
+                fig.canvas.draw()
+                background = fig.canvas.copy_from_bbox(ax.bbox)
+            fig.canvas.restore_region(background)
+            ax.draw_artist(line)
+            fig.canvas.blit(ax.bbox)
+            shown = n
+        fig.canvas.flush_events()
+        if finished:
+            break
+        time.sleep(1.0 / fps)
+
+    #keep the window until it is closed
+    line.set_animated(False)
+    fig.canvas.draw()
+    plt.show()
+
+def _interactive():
+    """ whether python runs interactively (a prompt, IPython or a notebook) """
+    import sys
+    if hasattr(sys, 'ps1') or sys.flags.interactive:
+        return True
+    try:
+        get_ipython
+    except NameError:
+        return False
+    return True
+
+class LivePlotSink(Sink):
+    """
+    Live plot of detector `y` against axis `x` (as PlotSink; x=None
+    plots against the point number), drawn by a separate process.
+    add() only copies the point into arrays shared with the plotting
+    process, so the sweep never waits for matplotlib. The plot is
+    redrawn `fps` times a second with blitting, and lines with more
+    points than the plot is pixels wide are decimated to their min/max
+    envelope (see decimate).
+
+    Holds up to `capacity` points (by default, the whole sweep); later
+    points are not plotted. One line, for 1-D sweeps.
+
+    The plot is a window of its own, made by the plotting process, so
+    it needs a GUI backend. From a notebook with the inline backend,
+    the process opens a separate GUI window where processes are
+    spawned (Windows, macOS), and shows nothing where they are forked
+    (Linux: it inherits the inline backend); use %matplotlib qt there,
+    or PlotSink.
+
+    If the plotting process dies, a warning (with its traceback) is
+    given once, and the sweep goes on without the plot. Closing the
+    window just stops the plot. At the end of a sweep run from a script
+    (not interactively), close() waits up to `wait` seconds (None: until
+    the window is closed) so the final plot is not killed with the
+    script; interactively it returns at once.
+    """
+    def __init__(self, x=-1, y=0, fmt='.-', fps=10, capacity=None, wait=None):
+        self.x = x
+        self.y = y
+        self.fmt = fmt
+        self.fps = fps
+        self.capacity = capacity
+        self.wait = wait
+        self.process = None
+
+    def start(self, sweep):
+        import multiprocessing
+        Sink.start(self, sweep)
+        if self.x is None:
+            self.xi = None
+        else:
+            self.xi = self.x if isinstance(self.x, int) else sweep.axis_names.index(self.x)
+            self.xi %= len(sweep.axes)
+        self.yi = self.y if isinstance(self.y, int) else sweep.detector_names.index(self.y)
+        capacity = self.capacity or int(np.prod(sweep.shape)) or 100000
+        self.xs = multiprocessing.Array('d', capacity)
+        self.ys = multiprocessing.Array('d', capacity)
+        self.count = multiprocessing.Value('l', 0)
+        self.done = multiprocessing.Event()
+        self.errors = multiprocessing.Queue()
+        self.n = 0
+        self._checked = time.time()
+        x_label = 'point' if self.xi is None else sweep.axis_names[self.xi]
+        self.process = multiprocessing.Process(
+            target=_live_plot,
+            args=(self.xs, self.ys, self.count, self.done, self.errors, x_label,
+                  sweep.detector_names[self.yi], self.fmt, self.fps))
+        self.process.daemon = True
+        self.process.start()
+
+    def _alive(self):
+        """ whether the plot is still up; warns (once) if its process crashed """
+        if self.process is None:
+            return False
+        if self.process.is_alive():
+            return True
+        if self.process.exitcode:
+            import warnings
+            try:
+                error = self.errors.get(timeout=1.)
+            except queue.Empty:
+                error = ''
+            warnings.warn('live plot process died (exit code %s), no more plotting\n%s'
+                          % (self.process.exitcode, error))
+        self.process = None
+        return False
+
+    def add(self, point):
+        if self.process is None or self.n >= len(self.xs):
+            return
+        # checking the process is a system call: about once a second
+        now = time.time()
+        if now - self._checked > 1.:
+            self._checked = now
+            if not self._alive():
+                return
+        # no locks: this is the only writer, and the count is published
+        # after the point, so the plot never reads a half-written point
+        self.xs.get_obj()[self.n] = self.n if self.xi is None else point.setpoint[self.xi]
+        self.ys.get_obj()[self.n] = point.values[self.yi]
+        self.n += 1
+        self.count.value = self.n
+
+    def close(self):
+        if not self._alive():
+            return
+        self.done.set()
+        if not _interactive():
+            self.process.join(self.wait)
+            self._alive()
+
+# -----------
+# CHECKPOINTS
+# -----------
+
+# atomic on POSIX and Windows (Python 3); os.rename on Python 2
+_replace = getattr(os, 'replace', os.rename)
+
+def _atomic_write(path, text):
+    """ write `text` to `path` so that the file is always either the old or the new one """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(tmp, path)
+
+class CheckpointSink(Sink):
+    """
+    Saves the points measured so far to `path` (JSON) every `every`
+    points, and when the sweep ends or is interrupted, so that the
+    sweep can be resumed from it (see load_checkpoint, and Sweep's
+    `resume`). Each save replaces the file atomically: a crash while
+    saving leaves the previous checkpoint. `parameters` (the scan's
+    parameter list) and `state` (a dict, e.g. instrument setpoints)
+    are saved with the points. Scalar detectors only.
+
+    When the sweep completes, the checkpoint is deleted (it is only
+    needed to resume), unless `keep`. Put this sink after the ones
+    that save the data: if one of them fails at the end, the sweep no
+    longer counts as completed, and the checkpoint stays.
+    """
+    def __init__(self, path, every=10, parameters=None, state=None, keep=False):
+        self.path = path
+        self.every = every
+        self.parameters = parameters
+        self.state = state
+        self.keep = keep
+        self.points = []
+
+    def start(self, sweep):
+        Sink.start(self, sweep)
+        self.points = []
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, point):
+        self.points.append([[int(i) for i in point.index],
+                            [float(v) for v in point.setpoint],
+                            [float(v) for v in point.values],
+                            float(point.time)])
+        if len(self.points) % self.every == 0:
+            self.save()
+
+    def save(self, complete=False):
+        import json
+        checkpoint = {'names': self.sweep.names,
+                      'start_time': self.sweep.start_time,
+                      'parameters': self.parameters,
+                      'state': self.state,
+                      'complete': complete,
+                      'points': self.points}
+        _atomic_write(self.path, json.dumps(checkpoint))
+
+    def close(self):
+        complete = getattr(self.sweep, 'completed', False)
+        if complete and not self.keep:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        self.save(complete=complete)
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint written by CheckpointSink: a dict of 'names',
+    'start_time', 'parameters', 'state', 'complete' and 'points' (the
+    measured Points, in order).
+    """
+    import json
+    with open(path) as f:
+        checkpoint = json.load(f)
+    checkpoint['points'] = [Point(tuple(index), tuple(setpoint), tuple(values), t)
+                            for index, setpoint, values, t in checkpoint['points']]
+    return checkpoint
+
+def _resume_points(resume, names):
+    """ the Points of checkpoint `resume` (a dict or a path), checked against `names` """
+    if resume is None:
+        return None, []
+    if not isinstance(resume, dict):
+        resume = load_checkpoint(resume)
+    if list(resume['names']) != list(names):
+        raise ValueError('checkpoint has columns %s, the sweep %s' % (resume['names'], names))
+    return resume['start_time'], resume['points']
+
+# -----
+# SWEEP
+# -----
+
+def _report_end_time(start_time, n_done, n_total):
+    elapsed = time.time() - start_time
+    end_time = start_time + elapsed * n_total / float(n_done)
+    print('Estimated scan end time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(end_time)))
+
+class Sweep(object):
+    """
+    Sweep over the grid of `axes` (outermost first), reading every
+    detector at each point and passing the point to `sinks`.
+
+    Only the axes whose value changes are set at each point, and the
+    sweep then waits for the longest of their settle times.
+
+    With `pipeline` (the default), points are measured on a worker
+    thread, up to `depth` points ahead of the sinks.
+
+    `resume` is a checkpoint (see CheckpointSink), or its path: its
+    points are passed to the sinks again first, the sweep keeps its
+    start time, and only the points it is missing are measured.
+    """
+    def __init__(self, axes, detectors, sinks=(), pipeline=True, depth=16,
+                 report=True, resume=None):
+        self.axes = list(axes)
+        self.detectors = list(detectors)
+        self.sinks = list(sinks)
+        self.pipeline = pipeline
+        self.depth = depth
+        self.report = report
+        self.resume = resume
+        self.start_time = None
+        self.completed = False
+        self._done = set()
+        self._stop = threading.Event()
+
+    @property
+    def axis_names(self):
+        return [axis.name for axis in self.axes]
+
+    @property
+    def detector_names(self):
+        return [det.name for det in self.detectors]
+
+    @property
+    def names(self):
+        return self.axis_names + self.detector_names
+
+    @property
+    def shape(self):
+        return tuple(len(axis) for axis in self.axes)
+
+    def stop(self):
+        """ stop after the current point (e.g. from a callback) """
+        self._stop.set()
+
+    def _measure(self):
+        """ generate the Points, setting the axes and reading the detectors """
+        last = [None] * len(self.axes)
+        for index in itertools.product(*[range(n) for n in self.shape]):
+            if self._stop.is_set():
+                return
+            if index in self._done:
+                continue
+            settle = 0.
+            for i, axis in enumerate(self.axes):
+                if index[i] != last[i]:
+                    axis.set(axis.values[index[i]])
+                    settle = max(settle, axis.settle)
+            last = list(index)
+            time.sleep(settle)
+            values = tuple(det.read() for det in self.detectors)
+            setpoint = tuple(axis.values[i] for axis, i in zip(self.axes, index))
+            yield Point(index, setpoint, values, time.time() - self.start_time)
+
+    def _measure_ahead(self):
+        """ _measure() on a worker thread, handing points over by a queue """
+        points = queue.Queue(self.depth)
+        done = object()
+        errors = []
+
+        def worker():
+            try:
+                for point in self._measure():
+                    points.put(point)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                points.put(done)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                point = points.get()
+                if point is done:
+                    break
+                yield point
+        finally:
+            # also on KeyboardInterrupt: let the worker finish its point
+            self._stop.set()
+            while thread.is_alive():
+                try:
+                    points.get(timeout=.1)
+                except queue.Empty:
+                    pass
+        if errors:
+            raise errors[0]
+
+    def __iter__(self):
+        """ run the sweep, yielding the points as they are measured """
+        self._stop.clear()
+        self.completed = False
+        run_start = time.time()
+        resume_start, done = _resume_points(self.resume, self.names)
+        self.start_time = resume_start if done else run_start
+        self._done = set(point.index for point in done)
+        if self.report:
+            print('Scan start time: ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time)))
+            if done:
+                print('Resuming after %d points' % len(done))
+        for sink in self.sinks:
+            sink.start(self)
+        total = int(np.prod(self.shape)) - len(self._done)
+        points = self._measure_ahead() if self.pipeline else self._measure()
+        try:
+            for point in done:
+                for sink in self.sinks:
+                    sink.add(point)
+                yield point
+            n = 0
+            for point in points:
+                if n == 0 and self.report:
+                    _report_end_time(run_start, 1, total)
+                n += 1
+                for sink in self.sinks:
+                    sink.add(point)
+                yield point
+            self.completed = n == total
+        finally:
+            points.close()
+            _close_sinks(self.sinks, self)
+
+    def run(self):
+        """
+        Run the whole sweep. Returns a SweepResult: the axis values,
+        and the detector values as arrays of the grid's shape (NaN
+        where the sweep did not get to).
+        """
+        data = {}
+        for point in self:
+            for det, value in zip(self.detectors, point.values):
+                if det.name not in data:
+                    dtype = float if np.ndim(value) == 0 else object
+                    data[det.name] = np.full(self.shape, np.nan, dtype=dtype)
+                data[det.name][point.index] = value
+        axes = dict((axis.name, axis.values) for axis in self.axes)
+        return SweepResult(axes, data, self.start_time)
+
+def _close_sinks(sinks, sweep):
+    """
+    Close every sink, even if an earlier one fails (e.g. a writer still
+    has to flush after the scan file could not be saved); the first
+    error is raised once they are all closed. After a failure the sweep
+    no longer counts as completed, so a CheckpointSink keeps its file.
+    """
+    error = None
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            if error is None:
+                error = e
+                sweep.completed = False
+    if error is not None:
+        raise error
+
+def stream(gen, names, sinks=(), report=False, resume=None):
+    """
+    Pass the tuples yielded by an existing scan generator (e.g.
+    expt_supp.gen_scan, which sets and reads the hardware itself) to
+    `sinks`, as the points of a 1-D sweep with columns `names` (the
+    axis first). Returns the rows as an array.
+
+    With `resume` (a checkpoint, or its path), its points go to the
+    sinks first; `gen` should then only produce the rest.
+    """
+    sweep = Sweep([Axis(names[0], [], None)],
+                  [Detector(name, None) for name in names[1:]],
+                  sinks=sinks, pipeline=False, report=report)
+    resume_start, done = _resume_points(resume, names)
+    sweep.start_time = resume_start if done else time.time()
+    for sink in sinks:
+        sink.start(sweep)
+    rows = []
+    try:
+        for point in done:
+            rows.append(tuple(point.setpoint) + tuple(point.values))
+            for sink in sinks:
+                sink.add(point)
+        for i, row in enumerate(gen, len(done)):
+            row = tuple(row)
+            rows.append(row)
+            point = Point((i,), row[:1], row[1:], time.time() - sweep.start_time)
+            for sink in sinks:
+                sink.add(point)
+        sweep.completed = True
+    finally:
+        _close_sinks(sinks, sweep)
+    return np.array(rows)
@@ -0,0 +1,250 @@
+'''
+timetag.py
+Photon time tagging with the DAQ card, and g2(tau) correlation of
+the tags, e.g. to check for a single emitter.
+
+The card time-tags photons by counting the edges of its internal
+timebase, and latching that count on every detector edge. Tags are
+in timebase ticks (12.5 ns for the 80 MHz timebase).
+
+Example:
+
+>>>tagger = TimeTagger()
+>>>g2 = G2Correlator(tau_max=500, bin_width=1)   # in ticks
+>>>tagger.start()
+>>>for i in range(600):
+...    time.sleep(.1)
+...    g2.update(tagger.read())
+>>>tagger.close()
+>>>plt.plot(g2.taus * tagger.tick, g2.g2())
+'''
+import numpy as np
+import PyDAQmx as daq
+from PyDAQmx import int32, byref
+from ring_buffer import RingBuffer
+
+# -----------
+# ACQUISITION
+# -----------
+
+class TimeTagger(object):
+    """
+    Buffered edge-timestamp counter: the counter `tagchan` counts the
+    `timebase`, and every edge of `detector` latches the count into the
+    card's buffer. read() streams the new tags into a ring buffer of
+    the last `buffer_size` tags.
+    """
+    def __init__(self, tagchan="Dev1/ctr0", detector="/Dev1/PFI8",
+                 timebase="/Dev1/80MHzTimebase", timebase_rate=80e6,
+                 max_rate=1e6, buffer_size=2**22, chunk=2**16):
+        self.tick = 1. / timebase_rate
+        self.tags = RingBuffer(buffer_size, dtype=np.uint64)
+        self._chunk = np.zeros(chunk, dtype=np.uint32)
+        self._last = 0    # last raw 32-bit tag, to spot rollovers
+        self._wraps = 0   # rollovers so far
+
+        self.ctr = daq.Task()
+        self.ctr.CreateCICountEdgesChan(tagchan, "",
+                                        daq.DAQmx_Val_Rising,
+                                        0,  # initial count
+                                        daq.DAQmx_Val_CountUp)
+        self.ctr.SetCICountEdgesTerm(tagchan, timebase)
+        # the "rate" is only a hint to size the card's buffer
+        self.ctr.CfgSampClkTiming(detector, max_rate, daq.DAQmx_Val_Rising,
+                                  daq.DAQmx_Val_ContSamps, chunk)
+
+    def start(self):
+        self._last = 0
+        self._wraps = 0
+        self.ctr.StartTask()
+
+    def stop(self):
+        self.ctr.StopTask()
+
+    def close(self):
+        self.ctr.ClearTask()
+
+    def read(self):
+        """
+        Fetch all tags latched since the last read, as 64-bit ticks.
+        They are also appended to self.tags.
+        """
+        blocks = []
+        read = int32()
+        while True:
+            # -1: whatever is available, without waiting
+            self.ctr.ReadCounterU32(-1, 0., self._chunk, len(self._chunk),
+                                    byref(read), None)
+            if read.value == 0:
+                break
+            blocks.append(self._unwrap(self._chunk[:read.value]))
+            if read.value < len(self._chunk):
+                break
+        if not blocks:
+            return np.zeros(0, dtype=np.uint64)
+        new = np.concatenate(blocks)
+        self.tags.extend(new)
+        return new
+
+    def _unwrap(self, raw):
+        """ extend 32-bit counter values to 64 bits across rollovers """
+        raw = raw.astype(np.int64)
+        steps = np.diff(raw, prepend=self._last)
+        wraps = self._wraps + np.cumsum(steps < 0)
+        self._last = raw[-1]
+        self._wraps = wraps[-1]
+        return (raw + (wraps << 32)).astype(np.uint64)
+
+# -----------
+# CORRELATION
+# -----------
+
+def _delay_histogram(a, b, lo, nbins, bin_width, auto=False):
+    """
+    Histogram of all delays b[j] - a[i] falling in
+    [lo, lo + nbins * bin_width), for sorted int64 arrays `a` and `b`.
+    With `auto`, `a` and `b` are the same tags, and the pairs of a tag
+    with itself are left out.
+    """
+    hi = lo + nbins * bin_width
+    first = np.searchsorted(b, a + lo, 'left')
+    last = np.searchsorted(b, a + hi, 'left')
+    n = last - first
+    total = n.sum()
+    hist = np.zeros(nbins, dtype=np.int64)
+    if total == 0:
+        return hist
+    # index of every partner in b, without a python loop over a
+    offsets = np.repeat(first - np.cumsum(n) + n, n) + np.arange(total)
+    delays = b[offsets] - np.repeat(a, n)
+    hist += np.bincount((delays - lo) // bin_width, minlength=nbins)
+    if auto and lo <= 0 < hi:
+        hist[-lo // bin_width] -= len(a)
+    return hist
+
+def _fft_histogram(a, b, lo, nbins, bin_width, auto=False):
+    """
+    Same as _delay_histogram, from the FFT cross-correlation of the
+    binned tags. Cheaper for dense tags, but delays are only resolved
+    to the bin grid, not to the tick.
+    """
+    hist = np.zeros(nbins, dtype=np.int64)
+    if len(a) == 0 or len(b) == 0:
+        return hist
+    base = min(a[0], b[0]) // bin_width
+    ia = a // bin_width - base
+    ib = b // bin_width - base
+    length = int(max(ia[-1], ib[-1])) + 1
+    lag_lo = lo // bin_width
+    size = 1
+    while size < length + nbins + abs(lag_lo):
+        size *= 2
+    xa = np.fft.rfft(np.bincount(ia, minlength=length), size)
+    xb = np.fft.rfft(np.bincount(ib, minlength=length), size)
+    corr = np.rint(np.fft.irfft(np.conj(xa) * xb, size)).astype(np.int64)
+    lags = np.arange(lag_lo, lag_lo + nbins)
+    hist += corr[lags % size]
+    if auto and lag_lo <= 0 < lag_lo + nbins:
+        hist[-lag_lo] -= len(a)
+    return hist
+
+class G2Correlator(object):
+    """
+    Running g2(tau) from time tags, with memory set by the number of
+    bins only: update() folds each new chunk of tags into a delay
+    histogram, keeping just the tags within `tau_max` of the end to
+    pair with the next chunk.
+
+    `tau_max` and `bin_width` are in the units of the tags (ticks).
+    Give update() one array for the autocorrelation of one detector,
+    or two for the cross-correlation of two (Hanbury Brown-Twiss).
+    method='fft' suits very dense tags.
+    """
+    def __init__(self, tau_max, bin_width=1, method='histogram'):
+        if method not in ('histogram', 'fft'):
+            raise ValueError("method must be 'histogram' or 'fft'")
+        self.bin_width = int(bin_width)
+        half = int(np.ceil(float(tau_max) / self.bin_width))
+        self.lo = -half * self.bin_width
+        self.nbins = 2 * half
+        self.hist = np.zeros(self.nbins, dtype=np.int64)
+        self._histogram = _delay_histogram if method == 'histogram' else _fft_histogram
+        self.reset()
+
+    def reset(self):
+        self.hist[:] = 0
+        self.n_a = self.n_b = 0
+        self.t_first = self.t_last = None
+        self._end_a = self._end_b = None
+        self._carry_a = self._carry_b = np.zeros(0, dtype=np.int64)
+
+    @property
+    def taus(self):
+        """ the center of each delay bin """
+        return self.lo + self.bin_width * (np.arange(self.nbins) + .5)
+
+    def update(self, a, b=None):
+        """ add a chunk of sorted tags (a, and b if cross-correlating) """
+        auto = b is None
+        a = np.asarray(a).astype(np.int64)
+        b = a if auto else np.asarray(b).astype(np.int64)
+        if len(a) == 0 and len(b) == 0:
+            return
+
+        all_a = np.concatenate((self._carry_a, a))
+        all_b = all_a if auto else np.concatenate((self._carry_b, b))
+        # pairs within the carried-over tags were counted last time
+        self.hist += self._histogram(all_a, all_b, self.lo, self.nbins,
+                                     self.bin_width, auto)
+        self.hist -= self._histogram(self._carry_a, self._carry_b, self.lo,
+                                     self.nbins, self.bin_width, auto)
+
+        self.n_a += len(a)
+        self.n_b += len(b)
+        ends = [x[-1] for x in (a, b) if len(x)]
+        starts = [x[0] for x in (a, b) if len(x)]
+        if self.t_first is None:
+            self.t_first = min(starts)
+        self.t_last = max(ends)
+        if len(a):
+            self._end_a = a[-1]
+        if len(b):
+            self._end_b = b[-1]
+
+        # keep the tags that can still pair with later ones: a later b
+        # comes after the last b seen so far, a later a after the last a
+        hi = self.lo + self.nbins * self.bin_width
+        end_a = self.t_last if self._end_a is None else self._end_a
+        end_b = self.t_last if self._end_b is None else self._end_b
+        self._carry_a = all_a[np.searchsorted(all_a, end_b - hi):]
+        self._carry_b = (self._carry_a if auto else
+                         all_b[np.searchsorted(all_b, end_a + self.lo):])
+
+    def g2(self):
+        """
+        The histogram normalized to uncorrelated (Poissonian) light,
+        so that g2 -> 1 at long delays.
+        """
+        if not self.n_a or not self.n_b or self.t_last <= self.t_first:
+            return np.zeros(self.nbins)
+        span = float(self.t_last - self.t_first)
+        expected = self.n_a * float(self.n_b) * self.bin_width / span
+        return self.hist / expected
+
+if __name__ == '__main__':
+    # check: a cross-correlation fed in chunks, whose two streams end
+    # at different times, against the histogram of the whole streams
+    rng = np.random.RandomState(0)
+    a = np.sort(rng.randint(0, 10**6, 20000)).astype(np.int64)
+    b = np.sort(rng.randint(0, 10**6, 20000)).astype(np.int64)
+    for method in ('histogram', 'fft'):
+        g2 = G2Correlator(500, bin_width=10, method=method)
+        cuts_a = np.sort(rng.randint(0, 10**6, 30))
+        cuts_b = np.sort(rng.randint(0, 10**6, 30))
+        ia = np.searchsorted(a, np.concatenate(([0], cuts_a, [10**6])))
+        ib = np.searchsorted(b, np.concatenate(([0], cuts_b, [10**6])))
+        for i in range(len(ia) - 1):
+            g2.update(a[ia[i]:ia[i + 1]], b[ib[i]:ib[i + 1]])
+        whole = g2._histogram(a, b, g2.lo, g2.nbins, g2.bin_width)
+        assert (g2.hist == whole).all(), (method, (whole - g2.hist).sum())
+    print('chunked cross-correlation matches the whole-stream histogram')
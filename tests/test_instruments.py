@@ -0,0 +1,73 @@
+'''
+Tests of the spectrum analyzer class in instruments.py, talking to a
+fake VISA resource instead of the instrument.
+'''
+import pytest
+
+from sjha_wang_lab.instruments import hp_e4401
+
+
+class FakeResource(object):
+    """
+    Stands in for a pyVisa Resource: records every command (and the
+    VISA timeout of every query), and answers queries from `replies`
+    (a reply may be a list, answered in turn, or an exception, raised).
+    """
+    def __init__(self, replies=None):
+        self.replies = dict(replies or {})
+        self.commands = []
+        self.timeout = 2000.0
+        self.query_timeouts = []
+
+    def write(self, command):
+        self.commands.append(command)
+
+    def query(self, command):
+        self.commands.append(command)
+        self.query_timeouts.append(self.timeout)
+        reply = self.replies[command]
+        if isinstance(reply, list):
+            reply = reply.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def test_sweep_timeout_from_sweep_time():
+    analyzer = hp_e4401(FakeResource({'SENS:SWE:TIME?': '+5.000E-02\n'}))
+    assert analyzer.get_sweep_time() == 0.05
+    assert analyzer.get_sweep_timeout() == pytest.approx(1.1)
+
+
+def test_sweep_sets_and_restores_the_visa_timeout():
+    inst = FakeResource({'INIT:IMM;*OPC?': '1'})
+    hp_e4401(inst).sweep(timeout=3.0)
+    assert inst.query_timeouts == [3000.0]
+    assert inst.timeout == 2000.0
+    assert inst.commands == ['INIT:IMM;*OPC?']
+
+
+def test_sweep_raises_on_timeout():
+    inst = FakeResource({'INIT:IMM;*OPC?': IOError('VI_ERROR_TMO')})
+    with pytest.raises(RuntimeError):
+        hp_e4401(inst).sweep(timeout=0.5)
+    assert inst.timeout == 2000.0
+
+
+def test_wait_sweep_polls_the_operation_complete_bit():
+    inst = FakeResource({'*ESR?': ['+0', '+0', '+1']})
+    analyzer = hp_e4401(inst)
+    analyzer.start_sweep()
+    analyzer.wait_sweep(timeout=1.0, poll=0.0)
+    assert inst.commands == ['*CLS;INIT:IMM;*OPC', '*ESR?', '*ESR?', '*ESR?']
+
+
+def test_wait_sweep_raises_on_timeout():
+    analyzer = hp_e4401(FakeResource({'*ESR?': '+0'}))
+    with pytest.raises(RuntimeError):
+        analyzer.wait_sweep(timeout=0.0, poll=0.0)
+
+
+def test_marker_power():
+    inst = FakeResource({'CALC:MARK1:MODE POS;X 2870.5 MHz;Y?': '-4.25E+01'})
+    assert hp_e4401(inst).marker_power(2870.5) == -42.5